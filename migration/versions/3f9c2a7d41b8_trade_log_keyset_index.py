@@ -0,0 +1,30 @@
+"""trade_log keyset index
+
+Revision ID: 3f9c2a7d41b8
+Revises: b3dd61b2d19f
+Create Date: 2026-10-16 12:10:42.517301
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9c2a7d41b8'
+down_revision: Union[str, None] = 'b3dd61b2d19f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_trade_log_ticker_create_at_id', 'trade_log',
+                    ['ticker', sa.text('create_at DESC'), sa.text('id DESC')], unique=False)
+    # покрывается составным индексом
+    op.drop_index(op.f('ix_trade_log_ticker'), table_name='trade_log')
+
+
+def downgrade() -> None:
+    op.create_index(op.f('ix_trade_log_ticker'), 'trade_log', ['ticker'], unique=False)
+    op.drop_index('ix_trade_log_ticker_create_at_id', table_name='trade_log')
@@ -0,0 +1,30 @@
+"""orders user listing index
+
+Revision ID: 5b8e0f3c9a14
+Revises: 9d1e4b6a2c57
+Create Date: 2026-10-16 15:21:07.331842
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b8e0f3c9a14'
+down_revision: Union[str, None] = '9d1e4b6a2c57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_orders_user_status_create_at', 'orders',
+                    ['user_uuid', 'status', sa.text('create_at DESC'), sa.text('uuid DESC')], unique=False)
+    op.create_index('ix_orders_user_create_at', 'orders',
+                    ['user_uuid', sa.text('create_at DESC'), sa.text('uuid DESC')], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_orders_user_create_at', table_name='orders')
+    op.drop_index('ix_orders_user_status_create_at', table_name='orders')
@@ -0,0 +1,45 @@
+"""price_history candles
+
+Revision ID: 9d1e4b6a2c57
+Revises: 3f9c2a7d41b8
+Create Date: 2026-10-16 13:02:18.904215
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d1e4b6a2c57'
+down_revision: Union[str, None] = '3f9c2a7d41b8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # старые строки (цена без времени и объёма) в бары не переводятся
+    op.execute('DELETE FROM price_history')
+    op.drop_column('price_history', 'price')
+    op.add_column('price_history', sa.Column('interval', sa.String(length=3), nullable=False))
+    op.add_column('price_history', sa.Column('bucket', sa.TIMESTAMP(timezone=True), nullable=False))
+    op.add_column('price_history', sa.Column('open', sa.Float(), nullable=False))
+    op.add_column('price_history', sa.Column('high', sa.Float(), nullable=False))
+    op.add_column('price_history', sa.Column('low', sa.Float(), nullable=False))
+    op.add_column('price_history', sa.Column('close', sa.Float(), nullable=False))
+    op.add_column('price_history', sa.Column('volume', sa.Integer(), nullable=False))
+    op.create_unique_constraint('uq_price_history_bar', 'price_history', ['instrument_id', 'interval', 'bucket'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_price_history_bar', 'price_history', type_='unique')
+    op.execute('DELETE FROM price_history')
+    op.drop_column('price_history', 'volume')
+    op.drop_column('price_history', 'close')
+    op.drop_column('price_history', 'low')
+    op.drop_column('price_history', 'high')
+    op.drop_column('price_history', 'open')
+    op.drop_column('price_history', 'bucket')
+    op.drop_column('price_history', 'interval')
+    op.add_column('price_history', sa.Column('price', sa.Float(), nullable=False))
@@ -4,6 +4,7 @@ from fastapi import APIRouter, BackgroundTasks, HTTPException, status, Request,
 from pydantic import UUID4
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from src import schemas
 from src.db.db import get_async_session
 from src.db.instrumentManager import instrumentsManager
 from src.db.userManager import usersManager
@@ -24,7 +25,7 @@ async def add_instrument(request: Request,
         instrumentORM = await instrumentsManager.create(session, dict(instrument), request_id)
         backgroundTasks.add_task(clear_instruments_cache, request.state.request_id)
         api_logger.info(
-            f"[{request.state.request_id}] Create Instrument",
+            "[%s] Create Instrument", request.state.request_id,
             extra={
                 "status_code": 201,
                 "id": instrumentORM.id,
@@ -33,7 +34,7 @@ async def add_instrument(request: Request,
         return instrumentORM
     except HTTPException as e:
         api_logger.warning(
-            f"[{request.state.request_id}] Canceled The Creation Instrument",
+            "[%s] Canceled The Creation Instrument", request.state.request_id,
             extra={
                 "status_code": e.status_code,
                 "ticker": instrument.ticker,
@@ -43,7 +44,7 @@ async def add_instrument(request: Request,
         raise
     except Exception as e:
         api_logger.error(
-            f"[{request.state.request_id}] add_instrument unknown error",
+            "[%s] add_instrument unknown error", request.state.request_id,
             exc_info=e
         )
         raise HTTPException(500)
@@ -70,17 +71,18 @@ async def delete_user(request: Request, user_id: UUID4,
             await session.commit()
 
             database_logger.info(
-                f"[{request.state.request_id}] Delete user",
+                "[%s] Delete user", request.state.request_id,
                 extra={
                     "user_id": str(user_id),
                 }
             )
 
-            backgroundTasks.add_task(clear_user_cache, user.api_key, request_id)
+            # ключ отзывается до ответа: после него ни один процесс API не пустит пользователя из кеша
+            await clear_user_cache(user.api_key, request_id)
             backgroundTasks.add_task(usersManager.cancel_order_deleted_user, user.uuid, request_id)
 
             api_logger.info(
-                f"[{request.state.request_id}] Delete user",
+                "[%s] Delete user", request.state.request_id,
                 extra={
                     "user_id": str(user_id),
                 }
@@ -91,7 +93,7 @@ async def delete_user(request: Request, user_id: UUID4,
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     except HTTPException as e:
         api_logger.warning(
-            f"[{request.state.request_id}] Cannot Delete User",
+            "[%s] Cannot Delete User", request.state.request_id,
             extra={
                 'user_id': str(user_id),
                 "status_code": e.status_code,
@@ -101,7 +103,7 @@ async def delete_user(request: Request, user_id: UUID4,
         raise
     except Exception as e:
         api_logger.error(
-            f"[{request.state.request_id}] delete_user unknown error",
+            "[%s] delete_user unknown error", request.state.request_id,
             exc_info=e
         )
         raise HTTPException(500)
@@ -119,7 +121,7 @@ async def delete_instrument(request: Request, backgroundTasks: BackgroundTasks,
         backgroundTasks.add_task(instrumentsManager.cancel_order_deleted_ticker, deleted_instruments.id, request_id)
         backgroundTasks.add_task(update_cache_after_delete, ticker, request_id)
         api_logger.info(
-            f"[{request.state.request_id}] Delete instrument",
+            "[%s] Delete instrument", request.state.request_id,
             extra={
                 "ticker": ticker,
                 'id': deleted_instruments.id
@@ -129,7 +131,7 @@ async def delete_instrument(request: Request, backgroundTasks: BackgroundTasks,
         return BaseAnswer()
     except HTTPException as e:
         api_logger.warning(
-            f"[{request.state.request_id}] Cannot delete instrument",
+            "[%s] Cannot delete instrument", request.state.request_id,
             extra={
                 "ticker": ticker,
                 "status_code": e.status_code,
@@ -139,7 +141,7 @@ async def delete_instrument(request: Request, backgroundTasks: BackgroundTasks,
         raise
     except Exception as e:
         api_logger.error(
-            f"[{request.state.request_id}] delete_instrument unknown error",
+            "[%s] delete_instrument unknown error", request.state.request_id,
             exc_info=e
         )
         raise HTTPException(500)
@@ -153,7 +155,7 @@ async def deposit(request: Request, deposit_obj: Deposit,
     try:
         await usersManager.deposit_user(session, deposit_obj, request.state.request_id)
         api_logger.info(
-            f"[{request.state.request_id}] Deposit",
+            "[%s] Deposit", request.state.request_id,
             extra={
                 'user': str(deposit_obj.user_id),
                 'ticker': deposit_obj.ticker,
@@ -164,7 +166,7 @@ async def deposit(request: Request, deposit_obj: Deposit,
         return BaseAnswer()
     except HTTPException as e:
         api_logger.warning(
-            f"[{request.state.request_id}] Cannot deposit",
+            "[%s] Cannot deposit", request.state.request_id,
             extra={
                 'status_code': e.status_code,
                 'detail': e.detail
@@ -173,7 +175,7 @@ async def deposit(request: Request, deposit_obj: Deposit,
         raise
     except Exception as e:
         api_logger.error(
-            f"[{request.state.request_id}] deposit unknown error",
+            "[%s] deposit unknown error", request.state.request_id,
             exc_info=e
         )
         raise HTTPException(500)
@@ -189,7 +191,7 @@ async def withdraw(deposit_obj: Deposit,
         await usersManager.withdraw_user(session, deposit_obj, request.state.request_id)
 
         api_logger.info(
-            f"[{request.state.request_id}] Withdraw",
+            "[%s] Withdraw", request.state.request_id,
             extra={
                 'user': str(deposit_obj.user_id),
                 'ticker': deposit_obj.ticker,
@@ -201,7 +203,7 @@ async def withdraw(deposit_obj: Deposit,
     except HTTPException as e:
 
         api_logger.warning(
-            f"[{request.state.request_id}] Cannot withdraw",
+            "[%s] Cannot withdraw", request.state.request_id,
             extra={"status_code": e.status_code, "detail": e.detail}
         )
         raise
@@ -209,7 +211,7 @@ async def withdraw(deposit_obj: Deposit,
     except Exception as e:
 
         api_logger.error(
-            f"[{request.state.request_id}] withdraw unknown error",
+            "[%s] withdraw unknown error", request.state.request_id,
             exc_info=e
         )
 
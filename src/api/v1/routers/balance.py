@@ -1,35 +1,43 @@
-import asyncio
-from http.client import HTTPException
-
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
 
 from src.db.db import get_async_session
 from src.logger import api_logger
-from src.models import UserBalances, Users
+from src.models import UserBalances, Instruments
+from src.redis_conn import redis_client
+from src.utils.balance_cache import balance_cache, balance_key, is_readable, parse_balances
+from src.utils.instrument_registry import instrument_registry
 
 router = APIRouter(tags=["balance"], prefix='/balance')
 
+
 @router.get('')
 async def get_balance(request: Request,
                       session: AsyncSession = Depends(get_async_session)):
-    await asyncio.sleep(0.5)
     request_id = request.state.request_id
     try:
         user_id = request.state.user.id
+        r = await redis_client.get_redis()
+
+        cached = await r.hgetall(balance_key(user_id))
+        if is_readable(cached):
+            result = {instrument_registry.tickers[instrument_id]: amount
+                      for instrument_id, amount in parse_balances(cached).items()
+                      if instrument_id in instrument_registry.active}
+        else:
+            # версия читается до снимка: если баланс изменится, пока читаем БД, кеш не заполнится
+            version = await balance_cache.version(r, user_id)
+            rows = (await session.execute(
+                select(UserBalances.instrument_id, UserBalances.available_balance, UserBalances.frozen_balance,
+                       Instruments.ticker, Instruments.is_active)
+                .join(Instruments, Instruments.id == UserBalances.instrument_id)
+                .where(UserBalances.user_uuid == user_id)
+            )).all()
+            await balance_cache.fill(r, user_id, version,
+                                     {row.instrument_id: (row.available_balance, row.frozen_balance) for row in rows})
+            result = {row.ticker: row.available_balance + row.frozen_balance for row in rows if row.is_active}
 
-        result = await session.execute(
-            select(Users)
-            .options(selectinload(Users.balances).selectinload(UserBalances.instrument))
-            .where(Users.uuid == user_id)
-        )
-        user = result.scalar_one()
-        result = {
-            item.instrument.ticker: item.available_balance + item.frozen_balance
-            for item in user.balances if item.instrument.is_active
-        }
         api_logger.info(
             "Get balance",
             extra={
@@ -40,7 +48,7 @@ async def get_balance(request: Request,
         return result
     except Exception as e:
         api_logger.error(
-            f'[{request_id}] get balance failed',
+            '[%s] get balance failed', request_id,
             exc_info=e,
         )
         raise HTTPException(500)
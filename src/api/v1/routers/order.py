@@ -1,148 +1,223 @@
-from fastapi import APIRouter, Request, Depends, HTTPException, BackgroundTasks, status
+from uuid import UUID
+
+from fastapi import APIRouter, Request, Depends, HTTPException, BackgroundTasks, Query, Response, status
 from pydantic import UUID4
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
 
 from src.db.db import get_async_session
-from src.db.orderManager import orderManager
+from src.db.orderManager import orderManager, encode_order_cursor
 from src.db.userManager import usersManager
 from src.logger import api_logger, cache_logger, database_logger
-from src.models import Orders, Users
-from src.models.orders import SideEnum, StatusEnum
+from src.models import Orders, Instruments
+from src.models.orders import SideEnum, StatusEnum, TypeEnum
 from src.redis_conn import redis_client
-from src.schemas.order import MarketOrder, LimitOrder, create_GetOrder
-from src.tasks.orders import execution_orders
-from src.utils.redis_utils import check_ticker_exists, calculate_order_cost
+from src.schemas.order import MarketOrder, LimitOrder, OrdersBatch, GetOrder, orders_json
+from src.engine.commands import push_order_command, push_order_commands, stream_key, cancel_command
+from src.engine.index import ORDER_INDEX, parse_index_entry
+from src.engine.results import result_waiter
+from src.config import settings
+from src.utils.redis_utils import check_ticker_exists
 
 
 router = APIRouter(prefix="/order", tags=["orders"])
 
 
-@router.get('/{order_id}')
+# до /{order_id}, иначе status разбирается как id заявки
+@router.get('/status', response_model=list[GetOrder], response_model_exclude_none=True)
+async def get_orders_status(request: Request,
+                            ids: str = Query(..., description="id заявок через запятую, до 1000"),
+                            session: AsyncSession = Depends(get_async_session)):
+    """Заявки пользователя по списку id, несуществующие и чужие пропускаются."""
+    request_id = request.state.request_id
+    try:
+        try:
+            order_ids = list(dict.fromkeys(UUID(order_id) for order_id in ids.split(',') if order_id))
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid order id")
+        if not order_ids or len(order_ids) > 1000:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="from 1 to 1000 ids expected")
+
+        r = await redis_client.get_redis()
+        orders = await orderManager.get_orders(session, order_ids, request.state.user.id, r)
+        api_logger.info(
+            "[%s] Get orders status", request_id,
+            extra={'orders': len(order_ids), 'found': len(orders)}
+        )
+        # записи кеша уже JSON, список собирается без повторного кодирования
+        return Response(f"[{','.join(orders)}]", media_type="application/json")
+    except HTTPException as e:
+        api_logger.warning(
+            "[%s] Get orders status", request_id,
+            extra={'detail': e.detail, }
+        )
+        raise
+    except Exception as e:
+        api_logger.error(
+            "[%s] BAD Get orders status", request_id,
+            exc_info=e
+        )
+        raise HTTPException(500)
+    finally:
+        await session.close()
+
+
+@router.get('/{order_id}', response_model=GetOrder, response_model_exclude_none=True)
 async def get_order(request: Request,
                     order_id: UUID4,
                     session: AsyncSession = Depends(get_async_session)):
     request_id = request.state.request_id
     try:
-        orderOrm = await orderManager.get_order(session, order_id, request.state.user.id)
-        order = create_GetOrder(orderOrm)
+        r = await redis_client.get_redis()
+        order = await orderManager.get_order(session, order_id, request.state.user.id, r)
         api_logger.info(
-            f"[{request_id}] Get order",
+            "[%s] Get order", request_id,
             extra={'order_id': str(order_id)}
         )
-        return order.model_dump(exclude_none=True)
+        # готовый JSON: response_model только для документации
+        return Response(order, media_type="application/json")
     except HTTPException as e:
         api_logger.warning(
-            f"[{request_id}] Get order",
+            "[%s] Get order", request_id,
             extra={'order_id': str(order_id), 'detail': e.detail, }
         )
         raise
     except Exception as e:
         api_logger.error(
-            f"[{request_id}] BAD Get order",
+            "[%s] BAD Get order", request_id,
             extra={'order_id': str(order_id), }
         )
         raise HTTPException(500)
 
 # TODO: разнести на несколько функций
 @router.delete('/{order_id}')
-async def cancel_order(request: Request,
-                       order_id: UUID4, session: AsyncSession = Depends(get_async_session)):
+async def cancel_order(request: Request, order_id: UUID4):
     request_id = request.state.request_id
     try:
         r = await redis_client.get_redis()
-        order = await r.hget('active_orders', str(order_id))
+        # индекс заявок в стакане: тикер и владелец без запроса в БД
+        entry = await r.hget(ORDER_INDEX, str(order_id))
 
-        if not order:
+        parsed = parse_index_entry(entry) if entry else None
+        if parsed is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        ticker, _, user_uuid, _ = parsed
+        if user_uuid != str(request.state.user.id):
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
         try:
-            query = select(Orders).options(selectinload(Orders.instrument)).where(Orders.uuid == order_id,)
-            orderOrm = (await session.execute(query)).scalar_one()
-            key = f"{int(orderOrm.price)}:{int(orderOrm.qty - orderOrm.filled)}:{orderOrm.uuid}"
-            orderbook_key = f"orderbook:{orderOrm.ticker}:{'asks' if orderOrm.side == SideEnum.SELL else 'bids'}"
-
-            pipe = r.pipeline()
-            pipe.zrem(orderbook_key, key)
-            pipe.hdel('active_orders', str(order_id))
-            await pipe.execute()
+            # снятие со стакана и разморозку делает владелец стакана, иначе он разойдётся с Redis
+            await push_order_command('cancel', order_id, ticker, request_id, r)
             cache_logger.info(
-                f"[{request_id}] cancel_order cache (delete cache)",
+                "[%s] cancel_order queued", request_id,
                 extra={'order_id': str(order_id)}
             )
         except Exception as e:
             cache_logger.error(
-                f"[{request_id}] cancel_order (delete cache)",
+                "[%s] cancel_order queued", request_id,
                 extra={'order_id': str(order_id)},
                 exc_info=e
             )
             raise
-
-        if orderOrm.side == SideEnum.BUY:
-            userBalanceRUB = await usersManager.get_user_balance_by_ticker(
-                session, orderOrm.user_uuid, ticker='RUB', create_if_missing=True
-            )
-            summa = orderOrm.price * (orderOrm.qty - orderOrm.filled)
-            userBalanceRUB.frozen_balance -= summa
-            userBalanceRUB.available_balance += summa
-        else:
-            userBalanceTicker = await usersManager.get_user_balance_by_ticker(
-                session, orderOrm.user_uuid, ticker=orderOrm.ticker, create_if_missing=True
-            )
-            userBalanceTicker.frozen_balance -= orderOrm.qty
-            userBalanceTicker.available_balance += orderOrm.qty
-
-        orderOrm.status = StatusEnum.CANCELLED
-        database_logger.info(
-            f"[{request_id}] cancel_order",
-            extra={'order_id': str(order_id)}
-        )
-        await session.commit()
     except HTTPException as e:
         api_logger.warning(
-            f"[{request_id}] cancel_order",
+            "[%s] cancel_order", request_id,
             extra={'order_id': str(order_id), 'detail': e.detail, }
         )
         raise
     except Exception as e:
         database_logger.error(
-            f"[{request_id}] cancel_order",
+            "[%s] cancel_order", request_id,
             extra={'order_id': str(order_id)}
         )
         api_logger.error(
-            f"[{request_id}] cancel_order",
+            "[%s] cancel_order", request_id,
             extra={'order_id': str(order_id)}
         )
         raise HTTPException(500)
 
     api_logger.info(
-        f"[{request_id}] cancel_order",
+        "[%s] cancel_order", request_id,
         extra={'order_id': str(order_id)}
     )
 
     return {"success": True}
 
 
+@router.delete('')
+async def cancel_orders(request: Request,
+                        ticker: str | None = Query(None, pattern='^[A-Z]{2,10}$'),
+                        side: SideEnum | None = None,
+                        session: AsyncSession = Depends(get_async_session)):
+    request_id = request.state.request_id
+    user = request.state.user
+    try:
+        query = (
+            select(Orders.uuid, Instruments.ticker)
+            .join(Orders.instrument)
+            .where(Orders.user_uuid == user.id,
+                   Orders.order_type == TypeEnum.LIMIT_ORDER,
+                   Orders.status.in_([StatusEnum.NEW, StatusEnum.PARTIALLY_EXECUTED]))
+        )
+        if ticker:
+            query = query.where(Instruments.ticker == ticker)
+        if side:
+            query = query.where(Orders.side == side)
+        by_ticker = {}
+        for order_id, order_ticker in await session.execute(query):
+            by_ticker.setdefault(order_ticker, []).append(order_id)
+        await session.close()
+
+        # все заявки тикера снимаются матчером одним атомарным шагом
+        r = await redis_client.get_redis()
+        pipe = r.pipeline(transaction=False)
+        for order_ticker, order_ids in by_ticker.items():
+            pipe.xadd(stream_key(order_ticker), cancel_command(order_ids, order_ticker, request_id))
+        await pipe.execute()
+    except Exception as e:
+        api_logger.error(
+            "[%s] cancel_orders", request_id,
+            extra={'user_id': str(user.id), 'ticker': ticker},
+            exc_info=e
+        )
+        raise HTTPException(500)
+
+    orders = sum(len(order_ids) for order_ids in by_ticker.values())
+    api_logger.info(
+        "[%s] cancel_orders queued", request_id,
+        extra={'user_id': str(user.id), 'ticker': ticker, 'orders': orders}
+    )
+    return {"success": True, "orders": orders}
+
+
 # TODO: разнести на несколько функций
-@router.get('')
+@router.get('', response_model=list[GetOrder], response_model_exclude_none=True)
 async def get_list_orders(request: Request,
+                          status_filter: StatusEnum | None = Query(None, alias="status"),
+                          ticker: str | None = Query(None, pattern='^[A-Z]{2,10}$'),
+                          cursor: str | None = Query(None, description="курсор следующей страницы"),
+                          limit: int = Query(100, gt=0, le=1000),
                           session: AsyncSession = Depends(get_async_session)):
+    """Заявки пользователя от новых к старым. Курсор следующей страницы - в заголовке X-Cursor-Next,
+    его нет на последней странице."""
     user = request.state.user
     request_id = request.state.request_id
     try:
-        user = (await session.execute(
-            select(Users).options(selectinload(Users.orders).selectinload(Orders.instrument)).where(
-                Users.uuid == user.id)
-        )).scalars().one()
+        rows = await orderManager.get_user_orders(session, user.id, limit, status=status_filter, ticker=ticker,
+                                                  cursor=cursor)
         api_logger.info(
-            f"[{request_id}] get_order list",
+            "[%s] get_order list", request_id,
             extra={'user_id': str(request.state.user.id)}
         )
-        return [create_GetOrder(order).model_dump(exclude_none=True) for order in user.orders]
+        response = Response(orders_json(rows), media_type="application/json")
+        if len(rows) == limit:
+            response.headers['X-Cursor-Next'] = encode_order_cursor(rows[-1])
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         api_logger.error(
-            f"[{request_id}] get_order list",
+            "[%s] get_order list", request_id,
             exc_info=e
         )
         raise HTTPException(500)
@@ -153,13 +228,13 @@ async def create_cancel_order(user, session, instrument_id, order_data, request_
         orderOrm.status = StatusEnum.CANCELLED
         await session.flush()
         database_logger.info(
-            f"[{request_id}] Create MarketOrder CANCELLED",
+            "[%s] Create MarketOrder CANCELLED", request_id,
             extra={'user_id': str(user.id), 'order_id': str(orderOrm.uuid)}
         )
         return orderOrm
     except Exception as e:
         database_logger.error(
-            f"[{request_id}] Create MarketOrder CANCELLED",
+            "[%s] Create MarketOrder CANCELLED", request_id,
             extra={'user_id': str(user.id), 'instrument_id':str(instrument_id)}
         )
 
@@ -192,59 +267,10 @@ async def create_order(request: Request, background_tasks: BackgroundTasks,
                                     detail=f"Not enough balance order_data.qty {order_data.qty} > your balance'"
                                            f"{userBalanceTicker.available_balance or None}'")
 
-            if isinstance(order_data, MarketOrder):
-                try:
-                    # самая дорогая продажа и вообще существует ли она
-                    total_cost, matched_orders = await calculate_order_cost(r, order_data.ticker,
-                                                                            order_data.qty, order_data.direction.value)
-                except ValueError as e:
-
-                    api_logger.warning(
-                        f"{request_id} Нет ликвидности", extra={'ticker': order_data.ticker, 'side': order_data.direction}
-                    )
-                    await session.close()
-                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,)
-
-                    #orderOrm = await create_cancel_order(user, session, instrument_id, order_data, request_id)
-                    #await session.commit()
-
-
-                    # api_logger.info(
-                    #     f"[{request_id}] create order CANCELLED",
-                    #     extra={'user_id': str(user.id), 'order_id': str(orderOrm.uuid)}
-                    # )
-                    #return {"order_id": orderOrm.uuid,
-                      #      "success": True}
-
         else:  # order_data.direction == SideEnum.BUY
-            if isinstance(order_data, MarketOrder):
-                # при рыночном пытаемся собрать самую дешёвую покупку и проверяем от этого его баланс
-                try:
-                    total_cost, matched_orders = await calculate_order_cost(r, order_data.ticker,
-                                                                            order_data.qty, order_data.direction.value)
-                except ValueError as e:
-
-                    api_logger.warning(
-                        f"{request_id} Нет ликвидности",
-                        extra={'ticker': order_data.ticker, 'side': order_data.direction}
-                    )
-                    await session.close()
-                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, )
-                    # orderOrm = await create_cancel_order(user, session, instrument_id, order_data, request_id)
-                    # await session.commit()
-                    # await session.close()
-                    # api_logger.info(
-                    #     f"[{request_id}] create order CANCELLED",
-                    #     extra={'user_id': str(user.id), 'order_id': str(orderOrm.uuid)}
-                    # )
-                    # return {"order_id": orderOrm.uuid,
-                    #         "success": True}
-                if total_cost > userBalanceRub.available_balance:
-                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                        detail='Not enough balance total_cost = '
-                                               '{}, your balance = {}'
-                                        .format(total_cost, userBalanceRub.available_balance))
-            else:  # isinstance(order_data, LimitOrder)
+            # при рыночном стоимость считает матчер по своему стакану и отменяет заявку,
+            # если не хватает ликвидности или денег
+            if isinstance(order_data, LimitOrder):
                 # при лимитном просто перемножаем и проверяем есть ли у пользователя такое колво денег
                 if order_data.qty * order_data.price > userBalanceRub.available_balance:
                     raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
@@ -254,43 +280,128 @@ async def create_order(request: Request, background_tasks: BackgroundTasks,
     except HTTPException as e:
         await session.close()
         api_logger.warning(
-            f"[{request_id}] create order | balance",
+            "[%s] create order | balance", request_id,
             extra={'user_id': str(user.id), 'status_code': e.status_code, 'detail': e.detail, }
         )
         raise
     except Exception as e:
         await session.close()
         api_logger.error(
-            f"[{request_id}] create order failed",
+            "[%s] create order failed", request_id,
             extra={'user_id': str(user.id), },
             exc_info=e
         )
         raise HTTPException(500)
     try:
         orderOrm = await orderManager.create_orderOrm(user, session, instrument_id, order_data)
-        if isinstance(order_data, MarketOrder):
-            await execution_orders(orderOrm, order_data.ticker,
-                                   userBalanceRub, userBalanceTicker,
-                                   matched_orders, total_cost, session, r)
-
-        else:
-            await session.commit()
-            await r.lpush("limit_orders", f"{orderOrm.uuid}:{order_data.ticker}:{request_id}")
-            # await match_order_limit(orderOrm, order_data.ticker, request_id)
-            # background_tasks.add_task(match_order_limit, orderOrm, order_data.ticker, request_id)
+        await session.commit()
+        await session.close()
+        if isinstance(order_data, LimitOrder):
+            # и рыночные, и лимитные матчатся только в процессе-владельце стакана
+            await push_order_command('order', orderOrm.uuid, order_data.ticker, request_id, r)
+            return {"order_id": orderOrm.uuid,
+                    "success": True}
+
+        # рыночная заявка исполняется сразу, поэтому отвечаем после матчера, а не после постановки в очередь
+        future = result_waiter.expect(orderOrm.uuid)
+        await push_order_command('order', orderOrm.uuid, order_data.ticker, request_id, r)
+        result = await result_waiter.wait(orderOrm.uuid, future, settings.ORDER_RESULT_TIMEOUT)
+        if result is None:
+            api_logger.warning(
+                "[%s] market order result timeout", request_id,
+                extra={'order_id': str(orderOrm.uuid)}
+            )
+        elif result["status"] == StatusEnum.CANCELLED.value:
+            # матчер отменил заявку: не хватило ликвидности или баланса
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=result["reason"])
         return {"order_id": orderOrm.uuid,
                 "success": True}
     except HTTPException as e:
         api_logger.warning(
-            f"[{request_id}] market order failed",
+            "[%s] market order failed", request_id,
             extra={'detail': e.detail, 'status_code': e.status_code}
         )
         raise
     except Exception as e:
         api_logger.error(
-            f"[{request_id}] market order failed",
+            "[%s] market order failed", request_id,
             exc_info=e,
         )
         raise HTTPException(500)
     finally:
         await session.close()
+
+
+@router.post("/batch")
+async def create_orders_batch(request: Request, orders_data: OrdersBatch,
+                              session: AsyncSession = Depends(get_async_session)):
+    r = await redis_client.get_redis()
+    user = request.state.user
+    request_id = request.state.request_id
+    results: list[dict | None] = [None] * len(orders_data)
+    try:
+        instruments = {}
+        for ticker in {order_data.ticker for order_data in orders_data}:
+            try:
+                instruments[ticker] = await check_ticker_exists(ticker, session)
+            except HTTPException:
+                pass
+        rub_id = await check_ticker_exists("RUB", session)
+        balances = await usersManager.get_user_balances(session, user.id, [rub_id, *instruments.values()])
+        # один снимок балансов на всю пачку: каждая принятая заявка уменьшает его для следующих
+        available = {instrument_id: balance.available_balance for instrument_id, balance in balances.items()}
+
+        accepted = []
+        for i, order_data in enumerate(orders_data):
+            instrument_id = instruments.get(order_data.ticker)
+            if instrument_id is None:
+                results[i] = {"success": False, "detail": "ticker not found"}
+                continue
+            if order_data.direction == SideEnum.SELL:
+                balance_id, amount = instrument_id, order_data.qty
+            elif isinstance(order_data, LimitOrder):
+                balance_id, amount = rub_id, order_data.qty * order_data.price
+            else:
+                # стоимость рыночной покупки считает матчер
+                balance_id, amount = None, 0
+            if balance_id is not None:
+                if amount > available.get(balance_id, 0):
+                    results[i] = {"success": False,
+                                  "detail": f"Not enough balance {amount} > {available.get(balance_id, 0)}"}
+                    continue
+                available[balance_id] -= amount
+            accepted.append((i, instrument_id, order_data))
+
+        order_ids = await orderManager.create_orders(
+            user, session, [(instrument_id, order_data) for _, instrument_id, order_data in accepted]
+        )
+        await session.commit()
+        await session.close()
+        if order_ids:
+            await push_order_commands(
+                [('order', order_id, order_data.ticker, request_id)
+                 for order_id, (_, _, order_data) in zip(order_ids, accepted)], r
+            )
+        for order_id, (i, _, _) in zip(order_ids, accepted):
+            results[i] = {"order_id": order_id, "success": True}
+
+        api_logger.info(
+            "[%s] create order batch", request_id,
+            extra={'user_id': str(user.id), 'orders': len(orders_data), 'accepted': len(accepted)}
+        )
+        return results
+    except HTTPException as e:
+        api_logger.warning(
+            "[%s] create order batch", request_id,
+            extra={'user_id': str(user.id), 'status_code': e.status_code, 'detail': e.detail, }
+        )
+        raise
+    except Exception as e:
+        api_logger.error(
+            "[%s] create order batch failed", request_id,
+            extra={'user_id': str(user.id), },
+            exc_info=e
+        )
+        raise HTTPException(500)
+    finally:
+        await session.close()
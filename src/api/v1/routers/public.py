@@ -2,20 +2,25 @@ import asyncio
 import hashlib
 import json
 import secrets
-from datetime import timezone
-from http.client import HTTPException
+from datetime import datetime, timezone
 
-from fastapi import APIRouter, status, Depends, BackgroundTasks, Path, Query, Request
+from fastapi import APIRouter, status, Depends, BackgroundTasks, HTTPException, Path, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy import select
 
 from src import schemas
 from src.db.db import get_async_session, AsyncSession
+from src.db.priceHistoryManager import priceHistoryManager
+from src.db.tradelogManager import tradeLogManager, encode_cursor
 from src.db.userManager import usersManager
+from src.engine.candles import candles_key
+from src.engine.market_data import market_data_hub, sse_event
+from src.engine.scripts import read_depth, read_tickers
 from src.logger import api_logger, cache_logger
 from src.models import TradeLog
 from src.redis_conn import redis_client
 from src.utils.get_resources import get_instruments
-from src.utils.redis_utils import load_user_redis
+from src.utils.redis_utils import load_user_redis, check_ticker_exists
 
 router = APIRouter(tags=["Public"], prefix='/public')
 
@@ -40,7 +45,7 @@ async def registration(request: Request, user: schemas.UserBase,
         model = schemas.UserRegister.model_validate(user, from_attributes=True)
 
         api_logger.info(
-            f'[{request_id}] User registered',
+            '[%s] User registered', request_id,
             extra={'user_id': str(model.id)}
         )
 
@@ -48,7 +53,7 @@ async def registration(request: Request, user: schemas.UserBase,
 
     except Exception as e:
         api_logger.error(
-            f'[{request_id}] bad registration',
+            '[%s] bad registration', request_id,
             exc_info=e
         )
 
@@ -62,88 +67,145 @@ async def get_instruments_api(request: Request, background_tasks: BackgroundTask
     try:
         instruments = await get_instruments(session, background_tasks)
         api_logger.info(
-            f'[{request_id}] Get instruments',
+            '[%s] Get instruments', request_id,
         )
         return instruments
     except Exception as e:
         api_logger.error(
-            f'[{request_id}] bad get instruments',
+            '[%s] bad get instruments', request_id,
             exc_info=e
         )
         raise HTTPException(500)
 
 
 @router.get('/transactions/{ticker}', name='get_instrument')
-async def get_transaction(request: Request, ticker: str = Path(pattern='^[A-Z]{2,10}$'),
-                          limit: int = Query(10, gt=0), session: AsyncSession = Depends(get_async_session)):
+async def get_transaction(request: Request, response: Response, ticker: str = Path(pattern='^[A-Z]{2,10}$'),
+                          limit: int = Query(10, gt=0, le=1000),
+                          before: str | None = Query(None, description="курсор: сделки старше"),
+                          after: str | None = Query(None, description="курсор: сделки новее"),
+                          start: datetime | None = None, end: datetime | None = None,
+                          session: AsyncSession = Depends(get_async_session)):
+    """Сделки тикера от новых к старым. Курсоры следующей страницы в заголовках
+    X-Cursor-Before (старше последней) и X-Cursor-After (новее первой)."""
     request_id = request.state.request_id
     try:
 
-        if limit < 199:
+        if limit < 199 and not (before or after or start or end):
             r = await redis_client.get_redis()
             key = f"ticker:{ticker}"
             raw_data = await r.lrange(key, 0, limit - 1)
             api_logger.info(
-                f'[{request_id}] get_transaction',
+                '[%s] get_transaction', request_id,
             )
             return [json.loads(tx) for tx in raw_data]
         else:
-            res = (await session.execute(
-                select(TradeLog).order_by(TradeLog.create_at).limit(limit)
-            )).scalars()
+            res = await tradeLogManager.get_trades(session, ticker, limit, before=before, after=after,
+                                                   start=start, end=end)
+            if res:
+                response.headers['X-Cursor-Before'] = encode_cursor(res[-1])
+                response.headers['X-Cursor-After'] = encode_cursor(res[0])
             api_logger.info(
-                f'[{request_id}] get_transaction',
+                '[%s] get_transaction', request_id,
             )
             return [{"ticker": item.ticker,
                      "amount": item.quantity,
                      "price": item.price,
                      "timestamp": item.create_at.replace(tzinfo=timezone.utc).isoformat()}
                     for item in res]
+    except HTTPException:
+        raise
     except Exception as e:
         api_logger.error(
-            f'[{request_id}] bad get_transaction',
+            '[%s] bad get_transaction', request_id,
             exc_info=e
         )
+        raise HTTPException(500)
     finally:
         await session.close()
 
 
-async def get_orderbook_levels(r, ticker: str, request_id, limit: int = 10):
-    await asyncio.sleep(0.5)
+@router.get('/tickers')
+async def get_tickers(request: Request):
+    """Сводка по всем тикерам: последняя цена, лучшие цены стакана, объём, оборот и VWAP за 24 часа.
+    Ведётся матчером при изменении стакана и расчёте сделок, здесь одно чтение HASH."""
+    request_id = request.state.request_id
     try:
-        ask_key = f"orderbook:{ticker}:asks"
-        bid_key = f"orderbook:{ticker}:bids"
+        r = await redis_client.get_redis()
+        summary = await read_tickers(r)
+        api_logger.info(
+            '[%s] get_tickers', request_id,
+        )
+        return [{"ticker": ticker,
+                 "last_price": data.get("last"),
+                 "best_bid": data.get("bid"),
+                 "best_ask": data.get("ask"),
+                 "volume_24h": data.get("volume", 0),
+                 "turnover_24h": data.get("turnover", 0),
+                 "vwap_24h": data["turnover"] / data["volume"] if data.get("volume") else None}
+                for ticker, data in sorted(summary.items())]
+    except Exception as e:
+        api_logger.error(
+            '[%s] bad get_tickers', request_id,
+            exc_info=e
+        )
+        raise HTTPException(500)
 
-        asks = await r.zrange(ask_key, 0, limit - 1, withscores=True)
-        bids = await r.zrevrange(bid_key, 0, limit - 1, withscores=True)
 
-        def format_orders(raw_orders):
-            dict_ = {}
-            for order_data, price in raw_orders:
-                if dict_.get(price):
-                    dict_[price] += int(order_data.split(":")[1])
-                else:
-                    dict_[price] = int(order_data.split(":")[1])
+@router.get('/candles/{ticker}')
+async def get_candles(request: Request, ticker: str = Path(pattern='^[A-Z]{2,10}$'),
+                      interval: str = Query('1m', pattern='^(1m|5m|1h|1d)$'),
+                      limit: int = Query(100, gt=0, le=1000),
+                      end: datetime | None = Query(None, description="бары, начавшиеся раньше"),
+                      session: AsyncSession = Depends(get_async_session)):
+    """OHLCV-бары тикера по возрастанию времени. Последние бары (в том числе текущий, незакрытый)
+    берутся из кеша в Redis, более старые - из price_history."""
+    request_id = request.state.request_id
+    try:
+        r = await redis_client.get_redis()
+        max_score = '+inf' if end is None else f"({end.timestamp()}"
+        bars = [json.loads(bar) for bar in await r.zrevrangebyscore(
+            candles_key(ticker, interval), max_score, '-inf', start=0, num=limit
+        )]
+        if len(bars) < limit:
+            instrument_id = await check_ticker_exists(ticker, session)
+            before = datetime.fromtimestamp(bars[-1]["timestamp"], timezone.utc) if bars else end
+            for bar in await priceHistoryManager.get_bars(session, instrument_id, interval,
+                                                          limit - len(bars), before):
+                bars.append({"timestamp": int(bar.bucket.timestamp()), "open": bar.open, "high": bar.high,
+                             "low": bar.low, "close": bar.close, "volume": bar.volume})
+        api_logger.info(
+            '[%s] get_candles', request_id,
+            extra={'ticker': ticker}
+        )
+        return bars[::-1]
+    except HTTPException:
+        raise
+    except Exception as e:
+        api_logger.error(
+            '[%s] bad get_candles', request_id,
+            exc_info=e
+        )
+        raise HTTPException(500)
+    finally:
+        await session.close()
 
-            return [
-                {
-                    "price": price,
-                    "qty": qty
-                }
-                for price, qty in dict_.items()
-            ]
+
+async def get_orderbook_levels(r, ticker: str, request_id, limit: int = 10):
+    try:
+        # глубина по ценам поддерживается матчером вместе со стаканом, здесь только чтение limit уровней
+        asks, bids, _ = await read_depth(r, ticker, limit)
 
         cache_logger.info(
-            f'[{request_id}] get orderbook levels',
+            '[%s] get orderbook levels', request_id,
             extra={'ticker': ticker}
         )
         return {
-            "ask_levels": format_orders(asks),
-            "bid_levels": format_orders(bids),
+            "ask_levels": [{"price": price, "qty": qty} for price, qty in asks],
+            "bid_levels": [{"price": price, "qty": qty} for price, qty in bids],
         }
     except Exception as e:
         cache_logger.error(
-            f'[{request_id}] bad get orderbook levels',
+            '[%s] bad get orderbook levels', request_id,
             exc_info=e
         )
         raise HTTPException(500)
@@ -160,13 +222,83 @@ async def get_orderbook(
         r = await redis_client.get_redis()
         res = await get_orderbook_levels(r, ticker, limit=limit, request_id=request_id)
         api_logger.info(
-            f'[{request_id}] get_orderbook',
+            '[%s] get_orderbook', request_id,
             extra={'ticker': ticker}
         )
         return res
     except Exception as e:
         api_logger.error(
-            f'[{request_id}] bad get_orderbook',
+            '[%s] bad get_orderbook', request_id,
+            exc_info=e
+        )
+        raise HTTPException(500)
+
+
+# раз в столько секунд без событий отправляется комментарий, чтобы прокси не закрывали соединение
+STREAM_KEEPALIVE = 15
+
+
+@router.get('/stream/{ticker}')
+async def stream_market_data(
+        request: Request,
+        ticker: str = Path(pattern='^[A-Z]{2,10}$'),
+        depth: int = Query(10, gt=0, le=100),
+):
+    """SSE: снимок стакана и последних сделок, затем L2 diff (event: l2, с номером seq) и сделки (event: trade).
+    Diff содержит новый объём изменившихся уровней, 0 - уровень исчез."""
+    request_id = request.state.request_id
+    r = await redis_client.get_redis()
+
+    async def read_snapshot() -> dict:
+        asks, bids, seq = await read_depth(r, ticker, depth)
+        return {
+            "seq": seq,
+            "ask_levels": [{"price": price, "qty": qty} for price, qty in asks],
+            "bid_levels": [{"price": price, "qty": qty} for price, qty in bids],
+            "trades": [json.loads(tx) for tx in await r.lrange(f"ticker:{ticker}", 0, 19)],
+        }
+
+    # подписываемся до чтения снимка: diff, пришедшие между ними, отбрасываются по seq
+    queue = await market_data_hub.subscribe(ticker)
+    try:
+        snapshot = await read_snapshot()
+    except Exception as e:
+        await market_data_hub.unsubscribe(ticker, queue)
+        api_logger.error(
+            '[%s] bad stream_market_data', request_id,
             exc_info=e
         )
         raise HTTPException(500)
+
+    async def events():
+        try:
+            yield sse_event('snapshot', snapshot)
+            seq = snapshot["seq"]
+            while True:
+                try:
+                    data = await asyncio.wait_for(queue.get(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if data is None:
+                    # не успевали читать, клиент переподключится и получит новый снимок
+                    break
+                if data['type'] == 'resync':
+                    # хаб переподключился к Redis, часть diff потеряна: отдаём новый снимок
+                    fresh = await read_snapshot()
+                    yield sse_event('snapshot', fresh)
+                    seq = fresh["seq"]
+                elif data['type'] == 'l2':
+                    if data['seq'] <= seq:
+                        continue
+                    yield sse_event('l2', data)
+                else:
+                    yield sse_event('trade', data)
+        finally:
+            await market_data_hub.unsubscribe(ticker, queue)
+
+    api_logger.info(
+        '[%s] stream_market_data', request_id,
+        extra={'ticker': ticker}
+    )
+    return StreamingResponse(events(), media_type='text/event-stream')
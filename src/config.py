@@ -16,6 +16,13 @@ class Settings(BaseSettings):
     REDIS_PORT: int = 6379
     ADMIN_API_KEY: str
 
+    # очередь заявок делится на партиции по тикеру, каждой партицией владеет ровно один воркер матчинга
+    MATCHER_PARTITIONS: int = 64
+    # 0 - по числу ядер
+    MATCHER_WORKERS: int = 0
+    # сколько API ждёт исполнения рыночной заявки, сек; по таймауту отвечает, что заявка принята
+    ORDER_RESULT_TIMEOUT: float = 5.0
+
     model_config = SettingsConfigDict(env_file=".env")
 
     def DATABASE_URL(self):
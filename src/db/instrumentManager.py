@@ -9,10 +9,11 @@ from sqlalchemy.orm import selectinload
 from .base import BaseManager
 from src.models import Instruments
 from .db import async_session_maker
-from .userManager import usersManager
 from ..logger import database_logger, cache_logger
-from ..models.orders import StatusEnum, SideEnum
+from ..models.orders import StatusEnum
 from ..redis_conn import redis_client
+from ..engine.commands import stream_key, cancel_command
+from ..utils.instrument_registry import instrument_registry
 
 
 class InstrumentsManager(BaseManager):
@@ -21,9 +22,10 @@ class InstrumentsManager(BaseManager):
     async def create(self, session: AsyncSession, data: dict, request_id) -> Any:
         try:
             res: Instruments = await super().create(session=session, data=data, request_id=request_id)
+            await instrument_registry.invalidate(await redis_client.get_redis())
 
             database_logger.info(
-                f"[{request_id}] Instrument create",
+                "[%s] Instrument create", request_id,
                 extra={
                     "instrument_name": data.get('name'),
                     "ticker": data.get('ticker'),
@@ -36,7 +38,7 @@ class InstrumentsManager(BaseManager):
             if "uq_active_ticker" in str(error).lower() or "duplicate key" in str(error).lower():
                 ticker = data.get('ticker', 'unknown')
                 database_logger.warning(
-                    f"[{request_id}] Instrument NOT create (uq_active_ticker)",
+                    "[%s] Instrument NOT create (uq_active_ticker)", request_id,
                     extra={
                         "instrument_name": data.get('name'),
                         "ticker": data.get('ticker'),
@@ -49,7 +51,7 @@ class InstrumentsManager(BaseManager):
 
             # Для других IntegrityError
             database_logger.warning(
-                f"[{request_id}] Database integrity error occurred (IntegrityError)",
+                "[%s] Database integrity error occurred (IntegrityError)", request_id,
             )
             raise HTTPException(
                 status_code=400,
@@ -58,7 +60,7 @@ class InstrumentsManager(BaseManager):
 
         except Exception as error:
             database_logger.error(
-                f"[{request_id}] Failed to create Instrument",
+                "[%s] Failed to create Instrument", request_id,
                 exc_info=error,
                 extra={
                     "instrument_name": data.get('name'),
@@ -94,13 +96,16 @@ class InstrumentsManager(BaseManager):
             result = await session.execute(stmt)
             deleted_instrument = result.scalar_one_or_none()
             await session.commit()
+            if deleted_instrument:
+                # заявки по тикеру должны перестать приниматься во всех процессах до ответа
+                await instrument_registry.invalidate(await redis_client.get_redis())
 
             if not deleted_instrument:
                 raise HTTPException(
                     status_code=404,
                     detail=f"Instrument with ticker {ticker} not found or already inactive"
                 )
-            database_logger.info(f"[{request_id}] Instrument deleted", extra={
+            database_logger.info("[%s] Instrument deleted", request_id, extra={
                 "ticker": ticker,
                 "id": deleted_instrument.id,
                 'instrument_name': deleted_instrument.name,
@@ -108,14 +113,14 @@ class InstrumentsManager(BaseManager):
 
             return deleted_instrument
         except HTTPException as e:
-            database_logger.warning(f"[{request_id}] Instrument Cannot deleted", extra={
+            database_logger.warning("[%s] Instrument Cannot deleted", request_id, extra={
                 "ticker": ticker,
                 "detail": e.detail,
             })
             raise
         except Exception as e:
             database_logger.error(
-                f"[{request_id}] Failed to delete Instrument",
+                "[%s] Failed to delete Instrument", request_id,
                 exc_info=e,
             )
             raise HTTPException(500)
@@ -132,54 +137,24 @@ class InstrumentsManager(BaseManager):
                 )
                 instruments = res.scalar_one_or_none()
                 r = await redis_client.get_redis()
-                pipe = r.pipeline()
-
-                for order in instruments.orders:
-                    if order.status == StatusEnum.EXECUTED or order.status == StatusEnum.CANCELLED:
-                        continue
-                    key = f"{int(order.price)}:{int(order.qty - order.filled)}:{order.uuid}:{round(order.create_at.timestamp(), 3)}"
-                    orderbook_key = f"orderbook:{order.ticker}:{'asks' if order.side == SideEnum.SELL else 'bids'}"
-                    order.status = StatusEnum.CANCELLED
-                    pipe.zrem(orderbook_key, key)
-                    pipe.hdel('active_orders', str(order.uuid))
-
-                    cache_logger.info(
-                        f"[{request_id}] cancel order (instrument)",
-                        extra={"orderbook_key": orderbook_key, 'key': key}
-                    )
 
-                    if order.side == SideEnum.BUY:
-                        userBalanceRUB = await usersManager.get_user_balance_by_ticker(
-                            session, order.user_uuid, ticker='RUB', create_if_missing=True
-                        )
-                        userBalanceRUB.frozen_balance -= order.price * (order.qty - order.filled)
-                        userBalanceRUB.available_balance += order.price * (order.qty - order.filled)
-                        database_logger.info(
-                            "Update balance(Cancel Order instrument)",
-                            extra={
-                                "user_id": str(order.user_uuid),
-                                "ticker": order.ticker,
-                                "available_balance +=": order.price * (order.qty - order.filled),
-                                "frozen_balance -=": order.price * (order.qty - order.filled)
-                            }
-                        )
-                    database_logger.info(
-                        f"[{request_id}] Cancel Order ( instrument )",
-                        extra={"id ": str(order.uuid), 'user_id': str(order.user_uuid),
-                               "side": order.side.value,
-                               "ticker": order.ticker,
-                               "price": order.price}
-                    )
-                await pipe.execute()
-                await session.commit()
+                # снимает со стакана и размораживает владелец стакана, все заявки тикера одной командой
+                order_ids = [order.uuid for order in instruments.orders
+                             if order.status not in (StatusEnum.EXECUTED, StatusEnum.CANCELLED)]
+                if order_ids:
+                    await r.xadd(stream_key(instruments.ticker), cancel_command(order_ids, instruments.ticker, request_id))
+                cache_logger.info(
+                    "[%s] Cancel Orders ( instrument ) queued", request_id,
+                    extra={"ticker": instruments.ticker, "orders": len(order_ids)}
+                )
                 await session.close()
         except Exception as e:
             database_logger.error(
-                f"[{request_id}] Cancel Order (DELETE instrument)",
+                "[%s] Cancel Order (DELETE instrument)", request_id,
                 exc_info=e
             )
             cache_logger.info(
-                f"[{request_id}] Cancel Order CACHE (DELETE instrument)",
+                "[%s] Cancel Order CACHE (DELETE instrument)", request_id,
                 exc_info=e)
         finally:
             await session.close()
@@ -1,12 +1,35 @@
+import base64
+import json
+from datetime import datetime
+
 from fastapi import HTTPException, status
-from sqlalchemy import select
-from sqlalchemy.orm import selectinload
+import uuid
+
+from sqlalchemy import select, insert, update, values, column, case, literal, func, tuple_, Integer, UUID
 
 
 from src.db.base import BaseManager
-from src.models import Orders
+from src.models import Orders, Instruments
 from src.models.orders import TypeEnum, SideEnum, StatusEnum
-from src.schemas.order import MarketOrder
+from src.schemas.order import MarketOrder, order_json
+from src.utils.order_cache import order_status_key, fill_order_cache
+
+
+# поля заявки, по которым строится её JSON (без тикера), в RETURNING расчёта и отмены
+ORDER_STATUS_COLUMNS = (Orders.uuid, Orders.status, Orders.user_uuid, Orders.side, Orders.qty, Orders.price,
+                        Orders.filled, Orders.create_at)
+
+
+def encode_order_cursor(row) -> str:
+    return base64.urlsafe_b64encode(f"{row.create_at.isoformat()}|{row.uuid}".encode()).decode()
+
+
+def decode_order_cursor(cursor: str) -> tuple[datetime, uuid.UUID]:
+    try:
+        create_at, order_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(create_at), uuid.UUID(order_id)
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid cursor")
 
 
 class OrderManager(BaseManager):
@@ -19,9 +42,9 @@ class OrderManager(BaseManager):
             order_type=TypeEnum.MARKET_ORDER if isinstance(order_data, MarketOrder) else TypeEnum.LIMIT_ORDER,
             side=SideEnum.BUY if order_data.direction.value == "BUY" else SideEnum.SELL,
             qty=order_data.qty,
-            status=StatusEnum.EXECUTED if isinstance(order_data, MarketOrder) else StatusEnum.NEW,
+            status=StatusEnum.NEW,
             price=None if isinstance(order_data, MarketOrder) else order_data.price,
-            filled=None if isinstance(order_data, MarketOrder) else 0,
+            filled=0,
         )
         session.add(orders)
         await session.flush()
@@ -29,14 +52,142 @@ class OrderManager(BaseManager):
         return orders
 
     @staticmethod
-    async def get_order(session, order_id, user_id):
-        orderOrm = (await session.execute(
-            select(Orders).options(selectinload(Orders.instrument)).where(Orders.uuid == order_id,
-                                                                          Orders.user_uuid == user_id)
-        )).scalars().one_or_none()
-        if not orderOrm:
+    async def cancel_orders(session, order_ids: list) -> list:
+        """Одним UPDATE переводит в CANCELLED ещё активные заявки из order_ids.
+        Уже исполненные или снятые не трогает, возвращает строки снятых: ORDER_STATUS_COLUMNS и instrument_id."""
+        if not order_ids:
+            return []
+        query = (
+            update(Orders)
+            .where(Orders.uuid.in_(order_ids),
+                   Orders.status.in_([StatusEnum.NEW, StatusEnum.PARTIALLY_EXECUTED]))
+            .values(status=StatusEnum.CANCELLED)
+            .returning(*ORDER_STATUS_COLUMNS, Orders.instrument_id)
+            .execution_options(synchronize_session=False)
+        )
+        return list(await session.execute(query))
+
+    @staticmethod
+    async def reject_order(session, order_id):
+        """Переводит в CANCELLED заявку, которую матчер ещё не рассчитал. Возвращает строку
+        ORDER_STATUS_COLUMNS и order_type или None, если заявка уже рассчитана."""
+        query = (
+            update(Orders)
+            .where(Orders.uuid == order_id, Orders.status == StatusEnum.NEW, Orders.activation_time.is_(None))
+            .values(status=StatusEnum.CANCELLED)
+            .returning(*ORDER_STATUS_COLUMNS, Orders.order_type)
+            .execution_options(synchronize_session=False)
+        )
+        return (await session.execute(query)).first()
+
+    async def create_orders(self, user, session, orders: list[tuple[int, MarketOrder]]) -> list:
+        """Пачка заявок [(instrument_id, order_data)] одним INSERT. uuid генерируются здесь,
+        чтобы не зависеть от порядка строк в RETURNING."""
+        rows = []
+        for instrument_id, order_data in orders:
+            rows.append({
+                "uuid": uuid.uuid4(),
+                "user_uuid": user.id,
+                "instrument_id": instrument_id,
+                "order_type": TypeEnum.MARKET_ORDER if isinstance(order_data, MarketOrder) else TypeEnum.LIMIT_ORDER,
+                "side": SideEnum.BUY if order_data.direction.value == "BUY" else SideEnum.SELL,
+                "qty": order_data.qty,
+                "status": StatusEnum.NEW,
+                "price": None if isinstance(order_data, MarketOrder) else order_data.price,
+                "filled": 0,
+            })
+        if rows:
+            await session.execute(insert(self.model).values(rows))
+        return [row["uuid"] for row in rows]
+
+    @staticmethod
+    def select_order_rows():
+        """Поля ответа по заявке строками Core, без загрузки ORM-объектов."""
+        return (
+            select(Orders.uuid, Orders.status, Orders.user_uuid, Orders.side, Instruments.ticker, Orders.qty,
+                   Orders.price, Orders.filled, Orders.create_at)
+            .join(Instruments, Instruments.id == Orders.instrument_id)
+        )
+
+    @staticmethod
+    async def get_order(session, order_id, user_id, r) -> str:
+        """JSON заявки пользователя: из кеша статусов, при промахе - из БД с заполнением кеша."""
+        cached = await r.get(order_status_key(order_id))
+        if cached:
+            if json.loads(cached)["user_id"] != str(user_id):
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                    detail="Order not found")
+            return cached
+        row = (await session.execute(
+            OrderManager.select_order_rows().where(Orders.uuid == order_id, Orders.user_uuid == user_id)
+        )).one_or_none()
+        if not row:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                 detail="Order not found")
+        pipe = r.pipeline(transaction=False)
+        fill_order_cache(pipe, [row])
+        await pipe.execute()
+        return order_json(row).decode()
+
+    @staticmethod
+    async def get_orders(session, order_ids: list, user_id, r) -> list[str]:
+        """JSON заявок пользователя по списку id одним MGET, промахи - одним запросом в БД.
+        Чужие и несуществующие заявки пропускаются."""
+        orders = dict(zip(order_ids, await r.mget([order_status_key(order_id) for order_id in order_ids])))
+        missing = [order_id for order_id, cached in orders.items() if cached is None]
+        if missing:
+            rows = (await session.execute(
+                OrderManager.select_order_rows().where(Orders.uuid.in_(missing), Orders.user_uuid == user_id)
+            )).all()
+            pipe = r.pipeline(transaction=False)
+            fill_order_cache(pipe, rows)
+            await pipe.execute()
+            orders.update((row.uuid, order_json(row).decode()) for row in rows)
+        user_id = str(user_id)
+        return [cached for cached in orders.values()
+                if cached is not None and json.loads(cached)["user_id"] == user_id]
+
+    @staticmethod
+    async def get_user_orders(session, user_id, limit: int, status: StatusEnum | None = None,
+                              ticker: str | None = None, cursor: str | None = None) -> list:
+        """Заявки пользователя от новых к старым, страница после cursor. Любая страница - диапазон
+        индекса ix_orders_user_status_create_at (или ix_orders_user_create_at без фильтра по статусу)."""
+        query = OrderManager.select_order_rows().where(Orders.user_uuid == user_id)
+        if status:
+            query = query.where(Orders.status == status)
+        if ticker:
+            query = query.where(Instruments.ticker == ticker)
+        if cursor:
+            create_at, order_id = decode_order_cursor(cursor)
+            query = query.where(tuple_(Orders.create_at, Orders.uuid) <
+                                tuple_(literal(create_at, Orders.create_at.type), literal(order_id, Orders.uuid.type)))
+        query = query.order_by(Orders.create_at.desc(), Orders.uuid.desc()).limit(limit)
+        return list((await session.execute(query)).all())
+
+    @staticmethod
+    async def fill_orders(session, fills: dict) -> dict:
+        """Одним UPDATE ... FROM (VALUES ...) добавляет исполненный объём заявкам стакана {uuid: qty}.
+        Возвращает обновлённые строки {uuid: строка ORDER_STATUS_COLUMNS}."""
+        if not fills:
+            return {}
+        v = values(column('uuid', UUID(as_uuid=True)), column('quantity', Integer), name='fills').data(
+            list(fills.items())
+        )
+        filled = func.coalesce(Orders.filled, 0) + v.c.quantity
+        query = (
+            update(Orders)
+            .where(Orders.uuid == v.c.uuid)
+            .values(
+                filled=filled,
+                status=case(
+                    (filled >= Orders.qty, literal(StatusEnum.EXECUTED, Orders.status.type)),
+                    else_=literal(StatusEnum.PARTIALLY_EXECUTED, Orders.status.type),
+                ),
+            )
+            .returning(*ORDER_STATUS_COLUMNS)
+            .execution_options(synchronize_session=False)
+        )
+        return {row.uuid: row for row in await session.execute(query)}
 
 
 orderManager = OrderManager()
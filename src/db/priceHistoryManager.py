@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from sqlalchemy import select
+
+from src.db.base import BaseManager
+from src.models import PriceHistory
+
+
+class PriceHistoryManager(BaseManager):
+    model = PriceHistory
+
+    async def get_bars(self, session, instrument_id: int, interval: str, limit: int,
+                       before: datetime | None = None) -> list[PriceHistory]:
+        """Бары от новых к старым, before - начало бакета, с которого (не включая) читать.
+        Диапазон уникального индекса (instrument_id, interval, bucket)."""
+        query = select(self.model).where(self.model.instrument_id == instrument_id,
+                                         self.model.interval == interval)
+        if before:
+            query = query.where(self.model.bucket < before)
+        query = query.order_by(self.model.bucket.desc()).limit(limit)
+        return list((await session.execute(query)).scalars().all())
+
+
+priceHistoryManager = PriceHistoryManager()
@@ -1,9 +1,56 @@
+import base64
+from datetime import datetime
+
+from fastapi import HTTPException, status
+from sqlalchemy import select, tuple_, literal
+
 from src.db.base import BaseManager
 from src.models import TradeLog
 
 
+def encode_cursor(trade: TradeLog) -> str:
+    return base64.urlsafe_b64encode(f"{trade.create_at.isoformat()}|{trade.id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        create_at, trade_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(create_at), int(trade_id)
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid cursor")
+
+
 class TradeLogManager(BaseManager):
     model = TradeLog
 
     async def create_trade_log(self, data) -> TradeLog:
         pass
+
+    def _cursor_key(self, cursor: str):
+        create_at, trade_id = decode_cursor(cursor)
+        return tuple_(literal(create_at, self.model.create_at.type), literal(trade_id, self.model.id.type))
+
+    async def get_trades(self, session, ticker: str, limit: int, before: str | None = None, after: str | None = None,
+                         start: datetime | None = None, end: datetime | None = None) -> list[TradeLog]:
+        """Сделки тикера от новых к старым. Пагинация по ключу (create_at, id), а не OFFSET:
+        любая страница - диапазон индекса ix_trade_log_ticker_create_at_id."""
+        key = tuple_(self.model.create_at, self.model.id)
+        query = select(self.model).where(self.model.ticker == ticker)
+        if start:
+            query = query.where(self.model.create_at >= start)
+        if end:
+            query = query.where(self.model.create_at < end)
+        if before:
+            query = query.where(key < self._cursor_key(before))
+
+        if after:
+            # более новые сделки: идём по индексу в обратную сторону и разворачиваем страницу
+            query = query.where(key > self._cursor_key(after))
+            query = query.order_by(self.model.create_at, self.model.id).limit(limit)
+            return list(reversed((await session.execute(query)).scalars().all()))
+
+        query = query.order_by(self.model.create_at.desc(), self.model.id.desc()).limit(limit)
+        return list((await session.execute(query)).scalars().all())
+
+
+tradeLogManager = TradeLogManager()
@@ -1,7 +1,7 @@
 from typing import Any
 
 from fastapi import HTTPException
-from sqlalchemy import select, or_, and_
+from sqlalchemy import select, update, insert, values, column, tuple_, or_, and_, Integer, Float, UUID
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
@@ -10,9 +10,11 @@ from .base import BaseManager
 from src.models import Users, UserBalances, Orders, Instruments
 from .db import async_session_maker
 from ..logger import database_logger, cache_logger, api_logger
-from ..models.orders import StatusEnum, SideEnum
+from ..models.orders import StatusEnum
 from ..redis_conn import redis_client
 from ..schemas.baseAnswers import BaseAnswer
+from ..engine.commands import stream_key, cancel_command
+from ..utils.balance_cache import balance_cache
 from ..utils.redis_utils import check_ticker_exists
 
 
@@ -40,23 +42,23 @@ class UsersManager(BaseManager):
                 available_balance=0,
                 frozen_balance=0,
             )
-            database_logger.info(f'[{request_id}] User registration', extra={"user_id":
+            database_logger.info('[%s] User registration', request_id, extra={"user_id":
                                                                                  str(user.uuid)})
             session.add(userBalances)
             await session.commit()
             return user
         except Exception as e:
-            database_logger.error(f'[{request_id}] Bad registration', exc_info=e)
+            database_logger.error('[%s] Bad registration', request_id, exc_info=e)
             raise
 
     async def create_admin(self, session: AsyncSession, data: dict, request_id) -> Any:
         try:
             user = await super().create(session, data, request_id)
-            database_logger.info(f'[{request_id}] User registration', extra={"user_id":
+            database_logger.info('[%s] User registration', request_id, extra={"user_id":
                                                                  str(user.uuid)})
             return user
         except Exception as e:
-            database_logger.error(f'[{request_id}] Bad registration', exc_info=e)
+            database_logger.error('[%s] Bad registration', request_id, exc_info=e)
             raise
 
     @staticmethod
@@ -69,7 +71,17 @@ class UsersManager(BaseManager):
 
         # Найти инструмент по тикеру
         instrument_id = await check_ticker_exists(ticker, session)
+        return await UsersManager.get_user_balance_by_instrument(
+            session, user_uuid, instrument_id, create_if_missing
+        )
 
+    @staticmethod
+    async def get_user_balance_by_instrument(
+            session: AsyncSession,
+            user_uuid,
+            instrument_id: int,
+            create_if_missing: bool = False
+    ) -> UserBalances | None:
         balance_result = await session.execute(
             select(UserBalances)
             .where(
@@ -91,6 +103,98 @@ class UsersManager(BaseManager):
 
         return balance
 
+    @staticmethod
+    async def get_user_balances(
+            session: AsyncSession,
+            user_uuid,
+            instrument_ids: list[int],
+            create_if_missing: bool = False
+    ) -> dict[int, UserBalances]:
+        """Балансы пользователя по нескольким инструментам одним запросом: {instrument_id: баланс}."""
+        balance_result = await session.execute(
+            select(UserBalances)
+            .where(
+                UserBalances.user_uuid == user_uuid,
+                UserBalances.instrument_id.in_(instrument_ids),
+            )
+        )
+        balances = {}
+        for balance in balance_result.scalars():
+            balances.setdefault(balance.instrument_id, balance)
+
+        if create_if_missing:
+            for instrument_id in instrument_ids:
+                if instrument_id not in balances:
+                    balances[instrument_id] = UserBalances(
+                        user_uuid=user_uuid,
+                        instrument_id=instrument_id,
+                        available_balance=0.0,
+                        frozen_balance=0.0
+                    )
+                    session.add(balances[instrument_id])
+        return balances
+
+    @staticmethod
+    async def lock_balances(session: AsyncSession, keys) -> set:
+        """Блокирует строки балансов {(user_uuid, instrument_id)} одним SELECT ... FOR UPDATE,
+        возвращает ключи, для которых строка уже есть.
+        Блокировки берутся в порядке id, поэтому параллельные расчёты не ловят deadlock."""
+        result = await session.execute(
+            select(UserBalances.user_uuid, UserBalances.instrument_id)
+            .where(tuple_(UserBalances.user_uuid, UserBalances.instrument_id).in_(list(keys)))
+            .order_by(UserBalances.id)
+            .with_for_update()
+        )
+        return {(row.user_uuid, row.instrument_id) for row in result}
+
+    @staticmethod
+    async def apply_balance_deltas(session: AsyncSession, deltas: dict):
+        """Применяет приращения {(user_uuid, instrument_id): [available, frozen]} одним UPDATE ... FROM (VALUES ...).
+        Приращения уже свёрнуты по пользователю: N сделок с одним контрагентом - одна строка."""
+        if not deltas:
+            return
+        existing = await UsersManager.lock_balances(session, deltas.keys())
+
+        # баланса по инструменту ещё нет (первая покупка тикера) - создаём сразу с приращением
+        missing = [{"user_uuid": user_uuid, "instrument_id": instrument_id,
+                    "available_balance": available, "frozen_balance": frozen}
+                   for (user_uuid, instrument_id), (available, frozen) in deltas.items()
+                   if (user_uuid, instrument_id) not in existing]
+        if missing:
+            await session.execute(insert(UserBalances).values(missing))
+
+        rows = [(user_uuid, instrument_id, available, frozen)
+                for (user_uuid, instrument_id), (available, frozen) in deltas.items()
+                if (user_uuid, instrument_id) in existing]
+        if not rows:
+            return
+        v = values(
+            column('user_uuid', UUID(as_uuid=True)), column('instrument_id', Integer),
+            column('available', Float), column('frozen', Float), name='deltas'
+        ).data(rows)
+        query = (
+            update(UserBalances)
+            .where(UserBalances.user_uuid == v.c.user_uuid, UserBalances.instrument_id == v.c.instrument_id)
+            .values(available_balance=UserBalances.available_balance + v.c.available,
+                    frozen_balance=UserBalances.frozen_balance + v.c.frozen)
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(query)
+
+    @staticmethod
+    async def commit_balance_change(session: AsyncSession, deltas: dict):
+        """Commit изменённых в сессии балансов и те же приращения {(user_uuid, instrument_id): [available, frozen]}
+        в кеш балансов."""
+        r = await redis_client.get_redis()
+        users = {user_uuid for user_uuid, _ in deltas}
+        await balance_cache.begin(r, users)
+        try:
+            await session.commit()
+        except Exception:
+            await balance_cache.abort(r, users)
+            raise
+        await balance_cache.apply(r, deltas)
+
     @staticmethod
     async def cancel_order_deleted_user(user_id, request_id):
         try:
@@ -107,34 +211,25 @@ class UsersManager(BaseManager):
                 r = await redis_client.get_redis()
                 pipe = r.pipeline()
 
+                # снимает со стакана, размораживает и меняет статус владелец стакана, по команде на тикер
+                by_ticker = {}
                 for order in orders:
-                    key = f"{int(order.price)}:{int(order.qty - order.filled)}:{order.uuid}:{round(order.create_at.timestamp(), 3)}"
-                    orderbook_key = f"orderbook:{order.ticker}:{'asks' if order.side == SideEnum.SELL else 'bids'}"
-                    pipe.zrem(orderbook_key, key)
-                    pipe.hdel('active_orders', str(order.uuid))
-                    old_status = order.status
-                    order.status = StatusEnum.CANCELLED
-                    database_logger.info(
-                        f"[{request_id}] Cancel Order (user)",
-                        extra={"id ": str(order.uuid), "old status": old_status.value, 'user_id': str(user_id),
-                               "side": order.side.value,
-                               "ticker": order.ticker,
-                               "price": order.price}
-                    )
+                    by_ticker.setdefault(order.ticker, []).append(order.uuid)
+                for ticker, order_ids in by_ticker.items():
+                    pipe.xadd(stream_key(ticker), cancel_command(order_ids, ticker, request_id))
                     cache_logger.info(
-                        f"[{request_id}] Cancel Order  (user) cache ",
-                        extra={"orderbook_key": orderbook_key, "key": key}
+                        "[%s] Cancel Orders (user) queued", request_id,
+                        extra={'user_id': str(user_id), "ticker": ticker, "orders": len(order_ids)}
                     )
 
                 await pipe.execute()
-                await session.commit()
         except Exception as e:
             database_logger.error(
-                f"[{request_id}] Cancel Order (DELETE USER)",
+                "[%s] Cancel Order (DELETE USER)", request_id,
                 exc_info=e
             )
             cache_logger.info(
-                f"[{request_id}] Cancel Order CACHE (DELETE USER)",
+                "[%s] Cancel Order CACHE (DELETE USER)", request_id,
                 exc_info=e)
             raise HTTPException(500)
 
@@ -174,9 +269,11 @@ class UsersManager(BaseManager):
                     session, deposit_obj.user_id, ticker='RUB', create_if_missing=True
                 )
                 userBalanceRUB.available_balance += deposit_obj.amount
-                await session.commit()
+                await usersManager.commit_balance_change(
+                    session, {(deposit_obj.user_id, userBalanceRUB.instrument_id): [deposit_obj.amount, 0]}
+                )
                 database_logger.info(
-                    f"[{request_id}] Deposit",
+                    "[%s] Deposit", request_id,
                     extra={
                         'user': str(deposit_obj.user_id),
                         'ticker': deposit_obj.ticker,
@@ -186,11 +283,11 @@ class UsersManager(BaseManager):
 
             except Exception as e:
                 database_logger.error(
-                    f"[{request_id}] Cannot deposit",
+                    "[%s] Cannot deposit", request_id,
                     exc_info=e
                 )
             api_logger.info(
-                f"[{request_id}] Deposit",
+                "[%s] Deposit", request_id,
                 extra={
                     'user': str(deposit_obj.user_id),
                     'ticker': deposit_obj.ticker,
@@ -216,9 +313,11 @@ class UsersManager(BaseManager):
                     frozen_balance=0,
                 )
                 session.add(user_balance)
-            await session.commit()
+            await usersManager.commit_balance_change(
+                session, {(user.uuid, instrument.id): [deposit_obj.amount, 0]}
+            )
             database_logger.info(
-                f"[{request_id}] Deposit",
+                "[%s] Deposit", request_id,
                 extra={
                     'user': str(deposit_obj.user_id),
                     'ticker': deposit_obj.ticker,
@@ -252,14 +351,16 @@ class UsersManager(BaseManager):
         try:
             userBalances.available_balance -= deposit_obj.amount
             database_logger.info(
-                f"[{request_id}] Withdraw",
+                "[%s] Withdraw", request_id,
                 extra={
                     'user': str(deposit_obj.user_id),
                     'ticker': deposit_obj.ticker,
                     'amount': deposit_obj.amount,
                 }
             )
-            await session.commit()
+            await usersManager.commit_balance_change(
+                session, {(deposit_obj.user_id, userBalances.instrument_id): [-deposit_obj.amount, 0]}
+            )
         except SQLAlchemyError as e:
             await session.rollback()
             raise e
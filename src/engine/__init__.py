@@ -0,0 +1,23 @@
+from .orderbook import OrderBook, RestingOrder
+from .matching import MatchingEngine
+from .index import ORDER_INDEX, index_entry, parse_index_entry
+from .commands import (ORDERS_STREAM, ORDERS_GROUP, partition_of, stream_key, partition_stream, order_command,
+                       cancel_command, push_order_command, push_order_commands)
+
+__all__ = [
+    "OrderBook",
+    "RestingOrder",
+    "MatchingEngine",
+    "ORDER_INDEX",
+    "index_entry",
+    "parse_index_entry",
+    "ORDERS_STREAM",
+    "ORDERS_GROUP",
+    "partition_of",
+    "stream_key",
+    "partition_stream",
+    "order_command",
+    "cancel_command",
+    "push_order_command",
+    "push_order_commands",
+]
@@ -0,0 +1,122 @@
+import json
+from datetime import datetime, timezone
+
+from sqlalchemy.dialects.postgresql import insert
+
+from src.db.db import async_session_maker
+from src.engine.commands import partition_of
+from src.models import PriceHistory
+
+# интервал -> длина бакета в секундах
+INTERVALS = {"1m": 60, "5m": 300, "1h": 3600, "1d": 86400}
+# сколько последних бакетов каждого интервала хранится в Redis, старше - только в price_history
+CACHE_BARS = 500
+
+
+def candles_key(ticker: str, interval: str) -> str:
+    return f"candles:{ticker}:{interval}"
+
+
+def bar_json(bucket: int, bar: list) -> str:
+    open_, high, low, close, volume = bar
+    return json.dumps({"timestamp": bucket, "open": open_, "high": high, "low": low, "close": close,
+                       "volume": volume})
+
+
+class CandleAggregator:
+    """OHLCV-бары тикеров воркера матчинга.
+
+    Сделки складываются в бары в памяти, раз в heartbeat изменённые бары пачкой уходят
+    в Redis (последние CACHE_BARS бакетов, ZSET со score = начало бакета) и в price_history.
+    Бар, которого нет в памяти, сначала подтягивается из Redis: после перезапуска воркера
+    или переезда партиции текущий бакет продолжается, а не начинается заново."""
+
+    def __init__(self):
+        # (ticker, interval) -> {начало бакета: [open, high, low, close, volume]}
+        self.bars: dict[tuple[str, str], dict[int, list]] = {}
+        # (ticker, interval, bucket) -> instrument_id
+        self.dirty: dict[tuple[str, str, int], int] = {}
+
+    async def add_trades(self, r, ticker: str, instrument_id: int, trades: list[tuple[float, int, datetime]]):
+        """trades - (цена, объём, время) в порядке исполнения."""
+        buckets = {(interval, int(ts.timestamp()) // seconds * seconds)
+                   for _, _, ts in trades for interval, seconds in INTERVALS.items()}
+        missing = [(interval, bucket) for interval, bucket in buckets
+                   if bucket not in self.bars.get((ticker, interval), {})]
+        if missing:
+            pipe = r.pipeline(transaction=False)
+            for interval, bucket in missing:
+                pipe.zrangebyscore(candles_key(ticker, interval), bucket, bucket)
+            for (interval, bucket), cached in zip(missing, await pipe.execute()):
+                bar = None
+                if cached:
+                    data = json.loads(cached[0])
+                    bar = [data["open"], data["high"], data["low"], data["close"], data["volume"]]
+                self.bars.setdefault((ticker, interval), {})[bucket] = bar
+
+        for price, qty, ts in trades:
+            for interval, seconds in INTERVALS.items():
+                bucket = int(ts.timestamp()) // seconds * seconds
+                bars = self.bars[(ticker, interval)]
+                bar = bars[bucket]
+                if bar is None:
+                    bars[bucket] = [price, price, price, price, qty]
+                else:
+                    bar[1] = max(bar[1], price)
+                    bar[2] = min(bar[2], price)
+                    bar[3] = price
+                    bar[4] += qty
+                self.dirty[(ticker, interval, bucket)] = instrument_id
+
+    async def flush(self, r):
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, {}
+        try:
+            await self._write(r, dirty)
+        except Exception:
+            # бары в памяти не тронуты, запишем их со следующим сбросом
+            self.dirty = {**dirty, **self.dirty}
+            raise
+
+        # в памяти остаются только текущие бакеты, в прошлые сделки уже не попадут
+        for bars in self.bars.values():
+            latest = max(bars)
+            for bucket in [bucket for bucket in bars if bucket != latest]:
+                del bars[bucket]
+
+    async def _write(self, r, dirty: dict[tuple[str, str, int], int]):
+        pipe = r.pipeline(transaction=False)
+        rows = []
+        for (ticker, interval, bucket), instrument_id in dirty.items():
+            bar = self.bars[(ticker, interval)][bucket]
+            key = candles_key(ticker, interval)
+            pipe.zremrangebyscore(key, bucket, bucket)
+            pipe.zadd(key, {bar_json(bucket, bar): bucket})
+            pipe.zremrangebyscore(key, '-inf', f"({bucket - CACHE_BARS * INTERVALS[interval]}")
+            rows.append({"instrument_id": instrument_id, "interval": interval,
+                         "bucket": datetime.fromtimestamp(bucket, timezone.utc),
+                         "open": bar[0], "high": bar[1], "low": bar[2], "close": bar[3], "volume": bar[4]})
+        await pipe.execute()
+
+        # бар в памяти полный, поэтому строка таблицы просто перезаписывается
+        query = insert(PriceHistory).values(rows)
+        query = query.on_conflict_do_update(
+            index_elements=[PriceHistory.instrument_id, PriceHistory.interval, PriceHistory.bucket],
+            set_={column: query.excluded[column] for column in ("open", "high", "low", "close", "volume")},
+        )
+        async with async_session_maker() as session:
+            await session.execute(query)
+            await session.commit()
+
+    def drop_partition(self, partition: int):
+        # тикеры партиции теперь считает другой воркер, при возврате бары подтянутся из Redis заново
+        for key in [key for key in self.bars if partition_of(key[0]) == partition]:
+            del self.bars[key]
+        # несброшенные после ошибки flush бары партиции тоже уходят: без self.bars их нечем записать,
+        # а KeyError в _write остановил бы сброс всех остальных тикеров
+        for key in [key for key in self.dirty if partition_of(key[0]) == partition]:
+            del self.dirty[key]
+
+
+candle_aggregator = CandleAggregator()
@@ -0,0 +1,48 @@
+import zlib
+
+from src.config import settings
+from src.redis_conn import redis_client
+
+ORDERS_STREAM = "orders_stream"
+ORDERS_GROUP = "matchers"
+# команды, которые матчер так и не смог выполнить: для ручного разбора
+DEAD_LETTER_STREAM = f"{ORDERS_STREAM}:dead_letter"
+
+
+def partition_of(ticker: str) -> int:
+    # crc32, а не hash(): номер партиции должен совпадать во всех процессах
+    return zlib.crc32(ticker.encode()) % settings.MATCHER_PARTITIONS
+
+
+def stream_key(ticker: str) -> str:
+    return partition_stream(partition_of(ticker))
+
+
+def partition_stream(partition: int) -> str:
+    return f"{ORDERS_STREAM}:{partition}"
+
+
+def order_command(action: str, order_uuid, ticker: str, request_id) -> dict:
+    # action: 'order' - сматчить новую заявку, 'cancel' - снять заявки со стакана (uuid через запятую)
+    return {"action": action, "order_id": str(order_uuid), "ticker": ticker, "request_id": str(request_id)}
+
+
+def cancel_command(order_uuids, ticker: str, request_id) -> dict:
+    # заявки одного тикера снимаются матчером одним атомарным шагом
+    return order_command('cancel', ','.join(str(order_uuid) for order_uuid in order_uuids), ticker, request_id)
+
+
+async def push_order_command(action: str, order_uuid, ticker: str, request_id, r=None):
+    if not r:
+        r = await redis_client.get_redis()
+    await r.xadd(stream_key(ticker), order_command(action, order_uuid, ticker, request_id))
+
+
+async def push_order_commands(commands: list[tuple], r=None):
+    """Пачка команд (action, order_uuid, ticker, request_id) одним pipeline."""
+    if not r:
+        r = await redis_client.get_redis()
+    pipe = r.pipeline(transaction=False)
+    for action, order_uuid, ticker, request_id in commands:
+        pipe.xadd(stream_key(ticker), order_command(action, order_uuid, ticker, request_id))
+    await pipe.execute()
@@ -0,0 +1,20 @@
+from src.engine.matching import parse_member
+from src.engine.orderbook import RestingOrder
+
+# индекс заявок, лежащих в стакане: uuid -> "тикер|сторона|владелец|member".
+# Обновляется в тех же Lua-скриптах, что и сам стакан, поэтому member в нём всегда актуален.
+# Не active_orders: там прежняя версия хранила uuid -> "active", такие значения индексом не разобрать
+ORDER_INDEX = "order_index"
+
+
+def index_entry(ticker: str, book_side: str, user_uuid, member: str) -> str:
+    return f"{ticker}|{book_side}|{user_uuid}|{member}"
+
+
+def parse_index_entry(entry: str) -> tuple[str, str, str, RestingOrder] | None:
+    """None - значение не в формате индекса, вызывающий считает заявку отсутствующей в стакане."""
+    try:
+        ticker, book_side, user_uuid, member = entry.split('|')
+        return ticker, book_side, user_uuid, parse_member(member)
+    except ValueError:
+        return None
@@ -0,0 +1,121 @@
+import asyncio
+import json
+
+from src.engine.scripts import md_channel
+
+# сколько событий может накопиться у медленного подписчика, после этого он отключается
+SUBSCRIBER_QUEUE_SIZE = 1000
+RETRY_DELAY = 1  # сек
+# событие подписчику после переподключения к Redis: пропущенные diff не восстановить, нужен новый снимок
+RESYNC = {"type": "resync"}
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class MarketDataHub:
+    """Маркет-дата для API-процесса: на тикер одна подписка на канал md:{ticker},
+    каждое событие разбирается один раз и раздаётся всем подписчикам процесса через их очереди.
+
+    В канал пишет только матчер: L2 diff из Lua-скриптов стакана (с номером md:{ticker}:seq)
+    и сделки после расчёта заявки. При обрыве связи хаб переподписывается на каналы всех тикеров
+    с подписчиками и кладёт каждому RESYNC: события за время обрыва потеряны."""
+
+    def __init__(self):
+        self.subscribers: dict[str, set[asyncio.Queue]] = {}
+        self._r = None
+        self._pubsub = None
+        self._task = None
+
+    async def start(self, r):
+        if self._task is not None:
+            return
+        self._r = r
+        self._pubsub = r.pubsub(ignore_subscribe_messages=True)
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        await self._close_pubsub()
+
+    async def _close_pubsub(self):
+        pubsub, self._pubsub = self._pubsub, None
+        if pubsub:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+    async def _resubscribe(self):
+        self._pubsub = self._r.pubsub(ignore_subscribe_messages=True)
+        channels = [md_channel(ticker) for ticker in self.subscribers]
+        if channels:
+            await self._pubsub.subscribe(*channels)
+        for ticker, queues in list(self.subscribers.items()):
+            for queue in list(queues):
+                self._put(ticker, queue, RESYNC)
+
+    async def _listen(self):
+        while True:
+            try:
+                if self._pubsub is None:
+                    await self._resubscribe()
+                # без подписок get_message нечего читать, ждём первого подписчика
+                if not self._pubsub.subscribed:
+                    await asyncio.sleep(0.1)
+                    continue
+                message = await self._pubsub.get_message(timeout=1.0)
+            except Exception as e:
+                print(f"market data subscription failed: {e}")
+                await self._close_pubsub()
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            if message is None or message['type'] != 'message':
+                continue
+            ticker = message['channel'].split(':', 1)[1]
+            data = json.loads(message['data'])
+            if data['type'] == 'l2':
+                # cjson кодирует пустой массив как объект
+                data['asks'] = data['asks'] or []
+                data['bids'] = data['bids'] or []
+            for queue in list(self.subscribers.get(ticker, ())):
+                self._put(ticker, queue, data)
+
+    def _put(self, ticker: str, queue: asyncio.Queue, data: dict):
+        try:
+            queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # подписчик не успевает, после переподключения он получит новый снимок
+            self._drop(ticker, queue)
+
+    def _drop(self, ticker: str, queue: asyncio.Queue):
+        # None в очереди - сигнал обработчику закрыть поток
+        self.subscribers.get(ticker, set()).discard(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    async def subscribe(self, ticker: str) -> asyncio.Queue:
+        queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        if not self.subscribers.get(ticker):
+            self.subscribers[ticker] = set()
+            # без связи канал подпишет _resubscribe
+            if self._pubsub is not None:
+                await self._pubsub.subscribe(md_channel(ticker))
+        self.subscribers[ticker].add(queue)
+        return queue
+
+    async def unsubscribe(self, ticker: str, queue: asyncio.Queue):
+        subscribers = self.subscribers.get(ticker)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self.subscribers[ticker]
+            if self._pubsub is not None:
+                await self._pubsub.unsubscribe(md_channel(ticker))
+
+
+market_data_hub = MarketDataHub()
@@ -0,0 +1,74 @@
+from src.engine.commands import partition_of
+from src.engine.orderbook import BookSide, OrderBook, RestingOrder, price_bound_score
+
+# стакан читается из Redis страницами растущего размера: 32, 128, 512, ...
+FIRST_PAGE = 32
+PAGE_GROWTH = 4
+
+
+def parse_member(member: str) -> RestingOrder:
+    price, qty, order_uuid, seq = member.split(':')
+    return RestingOrder(order_uuid, int(price), int(qty), int(seq))
+
+
+async def load_book(r, ticker: str) -> OrderBook:
+    # сами заявки подгружаются лениво через load_page, сразу читаем только счётчики
+    book = OrderBook(ticker)
+    pipe = r.pipeline()
+    pipe.get(f"orderbook:{ticker}:seq")
+    pipe.hgetall(f"orderbook:{ticker}:volume")
+    seq, volume = await pipe.execute()
+    book.seq = int(seq or 0)
+    book.asks.volume = int(volume.get('asks', 0))
+    book.bids.volume = int(volume.get('bids', 0))
+    return book
+
+
+async def load_page(r, book: OrderBook, book_side: BookSide, count: int):
+    # score задаёт порядок матчинга, поэтому следующая страница - это просто всё, что после frontier
+    start = '-inf' if book_side.frontier is None else f"({book_side.frontier}"
+    page = await r.zrange(f"orderbook:{book.ticker}:{book_side.name}", start, '+inf',
+                          byscore=True, offset=0, num=count, withscores=True)
+    for member, _ in page:
+        book.add(book_side, parse_member(member))
+    if page:
+        book_side.frontier = int(page[-1][1])
+    if len(page) < count:
+        book_side.complete = True
+
+
+class MatchingEngine:
+    """Стаканы всех тикеров, которыми владеет процесс матчинга."""
+
+    def __init__(self):
+        self.books: dict[str, OrderBook] = {}
+
+    async def get_book(self, r, ticker: str) -> OrderBook:
+        book = self.books.get(ticker)
+        if book is None:
+            book = self.books[ticker] = await load_book(r, ticker)
+        return book
+
+    def drop_book(self, ticker: str):
+        self.books.pop(ticker, None)
+
+    def drop_partition(self, partition: int):
+        # партиция ушла другому воркеру, он сам загрузит стаканы из Redis
+        for ticker in [ticker for ticker in self.books if partition_of(ticker) == partition]:
+            del self.books[ticker]
+
+    @staticmethod
+    async def ensure_liquidity(r, book: OrderBook, side: str, quantity: int, price_limit=None):
+        """Догружает противоположную сторону, пока в памяти не наберётся quantity по допустимой цене.
+        Объём чтения зависит от того, сколько ликвидности заявка реально заберёт, а не от глубины стакана."""
+        book_side = book.opposite_side(side)
+        bound = None if price_limit is None else price_bound_score(book_side.name, price_limit)
+        count = FIRST_PAGE
+        while not book_side.complete:
+            if bound is not None and book_side.frontier is not None and book_side.frontier >= bound:
+                break
+            _, available_qty = book.quote(side, quantity, price_limit)
+            if available_qty >= quantity:
+                break
+            await load_page(r, book, book_side, count)
+            count *= PAGE_GROWTH
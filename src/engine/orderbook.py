@@ -0,0 +1,189 @@
+from bisect import bisect_left, insort
+from collections import deque
+
+# score = цена * SEQ_SPAN + порядковый номер заявки, у bids цена со знаком минус.
+# ZRANGE по возрастанию сразу отдаёт обе стороны в порядке матчинга (цена, затем время),
+# поэтому пересортировка на клиенте не нужна. Чтобы score оставался точным в double,
+# цена должна быть меньше MAX_PRICE (проверяется в схеме LimitOrder), а номер в пределах тикера меньше SEQ_SPAN.
+SEQ_SPAN = 10 ** 9
+MAX_PRICE = 9_000_000
+
+
+def book_score(book_side: str, price: int, seq: int) -> int:
+    return (-price if book_side == 'bids' else price) * SEQ_SPAN + seq
+
+
+def price_bound_score(book_side: str, price_limit: int) -> int:
+    # максимальный score, который ещё проходит по лимитной цене
+    return book_score(book_side, price_limit, SEQ_SPAN - 1)
+
+
+class RestingOrder:
+    __slots__ = ('uuid', 'price', 'qty', 'seq')
+
+    def __init__(self, uuid: str, price: int, qty: int, seq: int):
+        self.uuid = uuid
+        self.price = price
+        self.qty = qty
+        self.seq = seq
+
+    @property
+    def member(self) -> str:
+        # тот же формат, что лежит в orderbook:{ticker}:{side}
+        return f"{self.price}:{self.qty}:{self.uuid}:{self.seq}"
+
+
+class BookSide:
+    """Одна сторона стакана: отсортированные ценовые уровни, на каждом FIFO-очередь заявок."""
+
+    def __init__(self, name: str):
+        self.name = name  # 'asks' | 'bids'
+        self.levels: dict[int, deque[RestingOrder]] = {}
+        # ключи приоритета по возрастанию, лучший уровень всегда в конце
+        self._keys: list[int] = []
+        # в памяти лежит только начало стороны: все заявки Redis со score <= frontier.
+        # complete - сторона загружена целиком
+        self.frontier: int | None = None
+        self.complete = False
+        # суммарный объём стороны, включая ещё не загруженный хвост
+        self.volume = 0
+
+    def _key(self, price: int) -> int:
+        return -price if self.name == 'asks' else price
+
+    def score(self, order: RestingOrder) -> int:
+        return book_score(self.name, order.price, order.seq)
+
+    def holds(self, order: RestingOrder) -> bool:
+        return self.complete or (self.frontier is not None and self.score(order) <= self.frontier)
+
+    def add(self, order: RestingOrder):
+        level = self.levels.get(order.price)
+        if level is None:
+            level = self.levels[order.price] = deque()
+            insort(self._keys, self._key(order.price))
+        level.append(order)
+
+    def remove(self, order: RestingOrder):
+        level = self.levels[order.price]
+        level.remove(order)
+        if not level:
+            self.drop_level(order.price)
+
+    def drop_level(self, price: int):
+        del self.levels[price]
+        del self._keys[bisect_left(self._keys, self._key(price))]
+
+    def crosses(self, price: int, price_limit) -> bool:
+        if price_limit is None:
+            return True
+        return price <= price_limit if self.name == 'asks' else price >= price_limit
+
+    def iter_levels(self):
+        for key in reversed(self._keys):
+            price = -key if self.name == 'asks' else key
+            yield price, self.levels[price]
+
+    def best_price(self) -> int | None:
+        if not self._keys:
+            return None
+        return -self._keys[-1] if self.name == 'asks' else self._keys[-1]
+
+
+class OrderBook:
+    """Резидентный стакан одного тикера. Источник правды для матчинга в процессе воркера,
+    Redis обновляется только дельтами."""
+
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.asks = BookSide('asks')
+        self.bids = BookSide('bids')
+        self.orders: dict[str, tuple[BookSide, RestingOrder]] = {}
+        # последний выданный порядковый номер, хранится в orderbook:{ticker}:seq
+        self.seq = 0
+
+    def next_seq(self) -> int:
+        self.seq += 1
+        return self.seq
+
+    def own_side(self, side: str) -> BookSide:
+        return self.bids if side == 'BUY' else self.asks
+
+    def opposite_side(self, side: str) -> BookSide:
+        return self.asks if side == 'BUY' else self.bids
+
+    def add(self, book_side: BookSide, order: RestingOrder):
+        book_side.add(order)
+        self.orders[order.uuid] = (book_side, order)
+
+    def rest(self, side: str, order: RestingOrder):
+        """Новая заявка в стакан. Если она попадает в незагруженный хвост, то остаётся только в Redis."""
+        book_side = self.own_side(side)
+        book_side.volume += order.qty
+        if book_side.holds(order):
+            self.add(book_side, order)
+
+    def cancel(self, book_side: BookSide, order_uuid: str, qty: int) -> RestingOrder | None:
+        """Убирает заявку, уже снятую в Redis. Если она лежала в незагруженном хвосте,
+        в памяти меняется только объём стороны."""
+        book_side.volume -= qty
+        entry = self.orders.pop(order_uuid, None)
+        if entry is None:
+            return None
+        book_side.remove(entry[1])
+        return entry[1]
+
+    def quote(self, side: str, quantity: int, price_limit=None) -> tuple[float, int]:
+        """Стоимость и доступный объём без изменения стакана."""
+        book_side = self.opposite_side(side)
+        remaining_qty = quantity
+        total_cost = 0.0
+        for price, level in book_side.iter_levels():
+            if remaining_qty <= 0 or not book_side.crosses(price, price_limit):
+                break
+            for order in level:
+                qty_to_take = min(remaining_qty, order.qty)
+                total_cost += qty_to_take * price
+                remaining_qty -= qty_to_take
+                if remaining_qty <= 0:
+                    break
+        return total_cost, quantity - remaining_qty
+
+    def match(self, side: str, quantity: int, price_limit=None) -> tuple[float, list[dict], int]:
+        book_side = self.opposite_side(side)
+        remaining_qty = quantity
+        total_cost = 0.0
+        matched_orders = []
+
+        while remaining_qty > 0:
+            price = book_side.best_price()
+            if price is None or not book_side.crosses(price, price_limit):
+                break
+            level = book_side.levels[price]
+
+            while level and remaining_qty > 0:
+                order = level[0]
+                qty_to_take = min(remaining_qty, order.qty)
+                cost = qty_to_take * price
+
+                matched_orders.append({
+                    "price": price,
+                    "quantity": qty_to_take,
+                    "cost": cost,
+                    "uuid": order.uuid,
+                    "original_qty": order.qty,
+                    "seq": order.seq,
+                })
+
+                total_cost += cost
+                remaining_qty -= qty_to_take
+                order.qty -= qty_to_take
+                if order.qty <= 0:
+                    level.popleft()
+                    del self.orders[order.uuid]
+
+            if not level:
+                book_side.drop_level(price)
+
+        book_side.volume -= quantity - remaining_qty
+        return total_cost, matched_orders, remaining_qty
@@ -0,0 +1,90 @@
+import time
+
+from src.config import settings
+
+WORKERS_KEY = "matcher:workers"
+HEARTBEAT_INTERVAL = 1  # сек
+# воркер без heartbeat дольше WORKER_TTL считается мёртвым, его партиции переходят к остальным
+WORKER_TTL = 5
+LEASE_TTL_MS = 5000
+
+# KEYS: lease-ключи сначала назначенных партиций, затем освобождаемых
+# ARGV: id воркера, ttl аренды в мс, кол-во назначенных партиций
+# Возвращает номера (позиции в KEYS) назначенных партиций, аренду которых воркер держит после вызова.
+LEASES_LUA = """
+local me = ARGV[1]
+local assigned = tonumber(ARGV[3])
+local held = {}
+for i = 1, assigned do
+    local owner = redis.call('GET', KEYS[i])
+    if owner == me then
+        redis.call('PEXPIRE', KEYS[i], ARGV[2])
+        table.insert(held, i)
+    elseif not owner then
+        redis.call('SET', KEYS[i], me, 'PX', ARGV[2])
+        table.insert(held, i)
+    end
+end
+for i = assigned + 1, #KEYS do
+    if redis.call('GET', KEYS[i]) == me then
+        redis.call('DEL', KEYS[i])
+    end
+end
+return held
+"""
+
+
+def lease_key(partition: int) -> str:
+    return f"matcher:partition:{partition}"
+
+
+class PartitionMembership:
+    """Какими партициями очереди владеет воркер.
+
+    Живые воркеры отмечаются в ZSET matcher:workers, партиция p назначается воркеру
+    с индексом p % N в отсортированном списке живых. Одного назначения мало: забрать партицию
+    можно только после того, как прежний владелец отпустит аренду matcher:partition:{p}
+    (или она истечёт после его смерти). Пока идёт команда, владелец продлевает аренду через renew,
+    так что два процесса матчат один тикер, только если владелец не может продлить её дольше
+    LEASE_TTL_MS: завис event loop или пропала связь с Redis."""
+
+    def __init__(self, r, worker_id: str):
+        self.r = r
+        self.worker_id = worker_id
+        self.owned: set[int] = set()
+        self._leases = r.register_script(LEASES_LUA)
+
+    async def heartbeat(self) -> tuple[set[int], set[int]]:
+        """Обновляет членство и аренды, возвращает партиции, которые воркер только что получил
+        и которые перестал держать."""
+        now = time.time()
+        pipe = self.r.pipeline()
+        pipe.zadd(WORKERS_KEY, {self.worker_id: now})
+        pipe.zremrangebyscore(WORKERS_KEY, '-inf', now - WORKER_TTL)
+        pipe.zrange(WORKERS_KEY, 0, -1)
+        *_, workers = await pipe.execute()
+
+        workers = sorted(workers)
+        index = workers.index(self.worker_id)
+        assigned = [p for p in range(settings.MATCHER_PARTITIONS) if p % len(workers) == index]
+        released = [p for p in self.owned if p not in assigned]
+
+        held = await self._leases(
+            keys=[lease_key(p) for p in assigned] + [lease_key(p) for p in released],
+            args=[self.worker_id, LEASE_TTL_MS, len(assigned)],
+        )
+        owned = {assigned[i - 1] for i in held}
+        acquired, lost = owned - self.owned, self.owned - owned
+        self.owned = owned
+        return acquired, lost
+
+    async def renew(self) -> set[int]:
+        """Продлевает аренды уже занятых партиций без пересчёта назначения, возвращает удержанные."""
+        owned = sorted(self.owned)
+        held = await self._leases(keys=[lease_key(p) for p in owned], args=[self.worker_id, LEASE_TTL_MS, len(owned)])
+        return {owned[i - 1] for i in held}
+
+    async def leave(self):
+        await self._leases(keys=[lease_key(p) for p in self.owned], args=[self.worker_id, LEASE_TTL_MS, 0])
+        await self.r.zrem(WORKERS_KEY, self.worker_id)
+        self.owned = set()
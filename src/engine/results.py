@@ -0,0 +1,92 @@
+import asyncio
+import json
+
+RESULTS_CHANNEL = "order_results"
+RETRY_DELAY = 1  # сек
+
+
+async def publish_result(r, order_uuid, status: str, filled: int, reason: str | None = None):
+    # reason - почему матчер отменил рыночную заявку, API отдаёт его в 400
+    await r.publish(RESULTS_CHANNEL, json.dumps({"order_id": str(order_uuid), "status": status, "filled": filled,
+                                                 "reason": reason}))
+
+
+class ResultWaiter:
+    """Результаты заявок для API-процесса: одна подписка на канал на весь процесс,
+    на каждую ожидаемую заявку - asyncio.Future.
+
+    Future заводится до отправки команды матчеру, поэтому результат не теряется,
+    даже если матчер ответит раньше, чем обработчик начнёт ждать. При обрыве подписки
+    результаты, пришедшие без неё, потеряны: ожидающие заявки сразу получают None, как по таймауту,
+    а подписка восстанавливается через RETRY_DELAY."""
+
+    def __init__(self):
+        self.futures: dict[str, asyncio.Future] = {}
+        self._r = None
+        self._pubsub = None
+        self._task = None
+
+    async def start(self, r):
+        if self._task is not None:
+            return
+        self._r = r
+        await self._subscribe()
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        await self._close_pubsub()
+
+    async def _subscribe(self):
+        self._pubsub = self._r.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(RESULTS_CHANNEL)
+
+    async def _close_pubsub(self):
+        pubsub, self._pubsub = self._pubsub, None
+        if pubsub:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+    async def _listen(self):
+        while True:
+            try:
+                if self._pubsub is None:
+                    await self._subscribe()
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except Exception as e:
+                print(f"order results subscription failed: {e}")
+                await self._close_pubsub()
+                self._fail_pending(e)
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            if message is None or message['type'] != 'message':
+                continue
+            data = json.loads(message['data'])
+            future = self.futures.pop(data['order_id'], None)
+            if future is not None and not future.done():
+                future.set_result(data)
+
+    def _fail_pending(self, error: Exception):
+        futures, self.futures = self.futures, {}
+        for future in futures.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"order results subscription lost: {error}"))
+
+    def expect(self, order_id) -> asyncio.Future:
+        future = self.futures[str(order_id)] = asyncio.get_running_loop().create_future()
+        return future
+
+    async def wait(self, order_id, future: asyncio.Future, timeout: float) -> dict | None:
+        """Результат матчера, None - не дождались: таймаут или обрыв подписки."""
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            return None
+        finally:
+            self.futures.pop(str(order_id), None)
+
+
+result_waiter = ResultWaiter()
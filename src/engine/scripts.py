@@ -0,0 +1,383 @@
+import json
+
+from src.engine.index import ORDER_INDEX, index_entry
+from src.engine.orderbook import RestingOrder, book_score
+
+# результат применённой к стакану команды хранится, пока заявка не рассчитана в БД:
+# при повторной доставке команды из стрима расчёт делается по нему, а не матчингом заново
+RESULT_TTL = 24 * 60 * 60
+
+# L2-глубина поддерживается теми же скриптами, что меняют стакан:
+# depth:{ticker}:{side} - HASH цена -> объём уровня и цена:n -> число заявок на уровне,
+# depth:{ticker}:{side}:prices - ZSET цен уровней, лучший уровень первый (как в самом стакане)
+DEPTH_LUA = """
+local changed = {asks = {}, bids = {}}
+
+local function depth(key, prices_key, side, price, qty, count)
+    changed[side][price] = true
+    local level_count = redis.call('HINCRBY', key, price .. ':n', count)
+    if level_count <= 0 then
+        redis.call('HDEL', key, price, price .. ':n')
+        redis.call('ZREM', prices_key, price)
+    else
+        redis.call('HINCRBY', key, price, qty)
+        if count > 0 then
+            redis.call('ZADD', prices_key, side == 'bids' and -tonumber(price) or tonumber(price), price)
+        end
+    end
+end
+
+-- изменённые уровни (новый объём, 0 - уровень исчез) уходят подписчикам маркет-даты
+-- с номером из md:{ticker}:seq, в том же атомарном шаге, что и изменение стакана,
+-- заодно обновляются лучшие цены тикера в сводке tickers
+local function publish_depth(seq_key, channel, asks_key, bids_key, summary_key, ticker)
+    local diff = {asks = {}, bids = {}}
+    local any = false
+    for side, prices in pairs(changed) do
+        local key = side == 'asks' and asks_key or bids_key
+        for price in pairs(prices) do
+            table.insert(diff[side], {tonumber(price), tonumber(redis.call('HGET', key, price) or 0)})
+            any = true
+        end
+    end
+    if any then
+        local seq = redis.call('INCR', seq_key)
+        redis.call('PUBLISH', channel, cjson.encode({type = 'l2', seq = seq, asks = diff.asks, bids = diff.bids}))
+        for side, field in pairs({asks = ':ask', bids = ':bid'}) do
+            local best = redis.call('ZRANGE', (side == 'asks' and asks_key or bids_key) .. ':prices', 0, 0)[1]
+            if best then
+                redis.call('HSET', summary_key, ticker .. field, best)
+            else
+                redis.call('HDEL', summary_key, ticker .. field)
+            end
+        end
+    end
+end
+"""
+
+# KEYS: 1 - противоположная сторона стакана, 2 - своя сторона, 3 - индекс заявок, 4 - orderbook:{ticker}:seq,
+#       5 - orderbook:{ticker}:volume, 6 - match_result:{uuid заявки},
+#       7, 8 - глубина противоположной стороны (HASH, ZSET), 9, 10 - глубина своей стороны, 11 - md:{ticker}:seq,
+#       12 - сводка tickers
+# ARGV: кол-во сделок, затем по 4 значения на сделку (старый member, новый member или '', score, uuid),
+#       затем остаток заявки (member или '', score, uuid, его порядковый номер, объём),
+#       затем имена сторон (противоположная, своя), исполненный объём, результат матчинга (json) и его ttl,
+#       запись индекса для остатка, канал маркет-даты, тикер
+# Сначала проверяем, что все снимаемые заявки лежат в стакане, и только потом пишем:
+# скрипт выполняется атомарно, поэтому стакан либо меняется целиком, либо не меняется совсем.
+COMMIT_MATCH_LUA = DEPTH_LUA + """
+local n = tonumber(ARGV[1])
+local rest = 2 + n * 4
+local opposite, own = ARGV[rest + 5], ARGV[rest + 6]
+if redis.call('EXISTS', KEYS[6]) == 1 then
+    return {2, ''}
+end
+for i = 0, n - 1 do
+    local base = 2 + i * 4
+    if not redis.call('ZSCORE', KEYS[1], ARGV[base]) then
+        return {0, ARGV[base + 3]}
+    end
+end
+for i = 0, n - 1 do
+    local base = 2 + i * 4
+    local price, old_qty = string.match(ARGV[base], '^(%d+):(%d+):')
+    redis.call('ZREM', KEYS[1], ARGV[base])
+    if ARGV[base + 1] ~= '' then
+        redis.call('ZADD', KEYS[1], ARGV[base + 2], ARGV[base + 1])
+        local entry = redis.call('HGET', KEYS[3], ARGV[base + 3])
+        if entry then
+            redis.call('HSET', KEYS[3], ARGV[base + 3], string.match(entry, '^(.*|)') .. ARGV[base + 1])
+        end
+        local new_qty = string.match(ARGV[base + 1], '^%d+:(%d+):')
+        depth(KEYS[7], KEYS[8], opposite, price, tonumber(new_qty) - tonumber(old_qty), 0)
+    else
+        redis.call('HDEL', KEYS[3], ARGV[base + 3])
+        depth(KEYS[7], KEYS[8], opposite, price, -tonumber(old_qty), -1)
+    end
+end
+if ARGV[rest] ~= '' then
+    redis.call('ZADD', KEYS[2], ARGV[rest + 1], ARGV[rest])
+    redis.call('HSET', KEYS[3], ARGV[rest + 2], ARGV[rest + 10])
+    redis.call('SET', KEYS[4], ARGV[rest + 3])
+    redis.call('HINCRBY', KEYS[5], own, ARGV[rest + 4])
+    depth(KEYS[9], KEYS[10], own, string.match(ARGV[rest], '^(%d+):'), tonumber(ARGV[rest + 4]), 1)
+end
+if n > 0 then
+    redis.call('HINCRBY', KEYS[5], opposite, -tonumber(ARGV[rest + 7]))
+end
+redis.call('SET', KEYS[6], ARGV[rest + 8], 'EX', ARGV[rest + 9])
+if opposite == 'asks' then
+    publish_depth(KEYS[11], ARGV[rest + 11], KEYS[7], KEYS[9], KEYS[12], ARGV[rest + 12])
+else
+    publish_depth(KEYS[11], ARGV[rest + 11], KEYS[9], KEYS[7], KEYS[12], ARGV[rest + 12])
+end
+return {1, n}
+"""
+
+
+# KEYS: 1 - индекс заявок, 2 - asks, 3 - bids, 4 - orderbook:{ticker}:volume, 5, 6 - глубина asks,
+#       7, 8 - глубина bids, 9 - md:{ticker}:seq, 10 - сводка tickers, затем cancel_result:{uuid} каждой заявки
+# ARGV: ttl результата, канал маркет-даты, тикер, затем uuid заявок
+# Заявки снимаются по записям индекса, без чтения БД и без восстановления member по полям заявки.
+# Все заявки тикера снимаются одним атомарным шагом. Возвращает записи индекса, '' - заявки в стакане уже нет.
+CANCEL_LUA = DEPTH_LUA + """
+local removed = {}
+local volume = {asks = 0, bids = 0}
+for i = 4, #ARGV do
+    local entry = redis.call('HGET', KEYS[1], ARGV[i])
+    local side, member, price, qty
+    if entry then
+        side, member = string.match(entry, '^[^|]*|([^|]*)|[^|]*|(.*)$')
+    end
+    if member then
+        price, qty = string.match(member, '^(%d+):(%d+):')
+    end
+    -- значение не в формате индекса: заявки в стакане нет, как и при отсутствии записи
+    if price and (side == 'asks' or side == 'bids') then
+        redis.call('ZREM', side == 'asks' and KEYS[2] or KEYS[3], member)
+        redis.call('HDEL', KEYS[1], ARGV[i])
+        if side == 'asks' then
+            depth(KEYS[5], KEYS[6], side, price, -tonumber(qty), -1)
+        else
+            depth(KEYS[7], KEYS[8], side, price, -tonumber(qty), -1)
+        end
+        redis.call('SET', KEYS[7 + i], cjson.encode({side = side, price = tonumber(price), qty = tonumber(qty)}),
+                   'EX', ARGV[1])
+        volume[side] = volume[side] + tonumber(qty)
+        table.insert(removed, entry)
+    else
+        table.insert(removed, '')
+    end
+end
+for side, qty in pairs(volume) do
+    if qty > 0 then
+        redis.call('HINCRBY', KEYS[4], side, -qty)
+    end
+end
+publish_depth(KEYS[9], ARGV[2], KEYS[5], KEYS[7], KEYS[10], ARGV[3])
+return removed
+"""
+
+
+# Сводка по тикерам для GET /public/tickers - один HASH tickers с полями {ticker}:{поле}:
+# last - цена последней сделки, ask/bid - лучшие цены (их ведёт publish_depth),
+# volume/turnover - объём и оборот за 24 часа, minute - последняя учтённая минута.
+# Скользящее окно - кольцо из 1440 минутных корзин tickers:{ticker}:minutes (номер минуты % 1440 ->
+# минута:объём:оборот): корзины, выпавшие из окна, вычитаются из сумм при следующей сделке или прокрутке.
+# KEYS: 1 - tickers, 2 - tickers:{ticker}:minutes; ARGV: тикер, минута, объём, оборот, цена последней сделки
+# (объём 0 и цена '' - только прокрутка окна)
+TRADE_STATS_LUA = """
+local ticker, minute = ARGV[1], tonumber(ARGV[2])
+local head = redis.call('HGET', KEYS[1], ticker .. ':minute')
+if not head and ARGV[3] == '0' and ARGV[5] == '' then
+    -- прокрутка тикера без сделок: сводку для него не заводим
+    return 0
+end
+head = tonumber(head or minute)
+if minute < head then
+    minute = head
+end
+for m = math.max(head - 1439, minute - 2879), minute - 1440 do
+    local slot = tostring(m % 1440)
+    local bucket = redis.call('HGET', KEYS[2], slot)
+    if bucket then
+        local bucket_minute, volume, turnover = string.match(bucket, '^(%d+):(%d+):(%d+)$')
+        if tonumber(bucket_minute) <= minute - 1440 then
+            redis.call('HINCRBY', KEYS[1], ticker .. ':volume', -tonumber(volume))
+            redis.call('HINCRBY', KEYS[1], ticker .. ':turnover', -tonumber(turnover))
+            redis.call('HDEL', KEYS[2], slot)
+        end
+    end
+end
+local volume, turnover = tonumber(ARGV[3]), tonumber(ARGV[4])
+if volume > 0 then
+    local slot = tostring(minute % 1440)
+    local bucket = redis.call('HGET', KEYS[2], slot)
+    if bucket then
+        local _, old_volume, old_turnover = string.match(bucket, '^(%d+):(%d+):(%d+)$')
+        volume, turnover = volume + tonumber(old_volume), turnover + tonumber(old_turnover)
+    end
+    redis.call('HSET', KEYS[2], slot, minute .. ':' .. volume .. ':' .. turnover)
+    redis.call('HINCRBY', KEYS[1], ticker .. ':volume', ARGV[3])
+    redis.call('HINCRBY', KEYS[1], ticker .. ':turnover', ARGV[4])
+end
+if ARGV[5] ~= '' then
+    redis.call('HSET', KEYS[1], ticker .. ':last', ARGV[5])
+end
+redis.call('HSET', KEYS[1], ticker .. ':minute', minute)
+return 1
+"""
+
+
+# KEYS: глубина asks (HASH, ZSET), глубина bids, md:{ticker}:seq; ARGV: число уровней
+# Возвращает по стороне плоский список цена, объём, цена, объём, ... и номер последнего diff,
+# на котором снимок актуален
+READ_DEPTH_LUA = """
+local result = {}
+for s = 0, 1 do
+    local levels = {}
+    for _, price in ipairs(redis.call('ZRANGE', KEYS[s * 2 + 2], 0, tonumber(ARGV[1]) - 1)) do
+        table.insert(levels, price)
+        table.insert(levels, redis.call('HGET', KEYS[s * 2 + 1], price))
+    end
+    table.insert(result, levels)
+end
+table.insert(result, tonumber(redis.call('GET', KEYS[5]) or 0))
+return result
+"""
+
+
+class BookConflict(Exception):
+    """Стакан в памяти разошёлся с Redis, сделки не записаны."""
+
+
+TICKERS_KEY = "tickers"
+TICKER_FIELDS = ("last", "ask", "bid", "volume", "turnover", "minute")
+
+
+def trade_minutes_key(ticker: str) -> str:
+    return f"tickers:{ticker}:minutes"
+
+
+def depth_keys(ticker: str, book_side: str) -> tuple[str, str]:
+    return f"depth:{ticker}:{book_side}", f"depth:{ticker}:{book_side}:prices"
+
+
+def md_channel(ticker: str) -> str:
+    return f"md:{ticker}"
+
+
+def md_seq_key(ticker: str) -> str:
+    return f"md:{ticker}:seq"
+
+
+def match_result_key(order_uuid) -> str:
+    return f"match_result:{order_uuid}"
+
+
+def cancel_result_key(order_uuid) -> str:
+    return f"cancel_result:{order_uuid}"
+
+
+async def get_result(r, key: str) -> dict | None:
+    result = await r.get(key)
+    return json.loads(result) if result else None
+
+
+async def get_results(r, keys: list[str]) -> list[dict | None]:
+    return [json.loads(result) if result else None for result in await r.mget(keys)]
+
+
+_commit_match = None
+_cancel = None
+_read_depth = None
+_trade_stats = None
+
+
+def get_commit_match_script(r):
+    # register_script сам делает EVALSHA и догружает скрипт при NOSCRIPT
+    global _commit_match
+    if _commit_match is None:
+        _commit_match = r.register_script(COMMIT_MATCH_LUA)
+    return _commit_match
+
+
+def get_cancel_script(r):
+    global _cancel
+    if _cancel is None:
+        _cancel = r.register_script(CANCEL_LUA)
+    return _cancel
+
+
+def get_read_depth_script(r):
+    global _read_depth
+    if _read_depth is None:
+        _read_depth = r.register_script(READ_DEPTH_LUA)
+    return _read_depth
+
+
+def get_trade_stats_script(r):
+    global _trade_stats
+    if _trade_stats is None:
+        _trade_stats = r.register_script(TRADE_STATS_LUA)
+    return _trade_stats
+
+
+async def record_trades(r, pipe, ticker: str, minute: int, volume: int = 0, turnover: int = 0, last_price=''):
+    """Добавляет сделки минуты в сводку тикера (в пайплайн pipe), без сделок - только сдвигает окно 24 часов."""
+    await get_trade_stats_script(r)(
+        keys=[TICKERS_KEY, trade_minutes_key(ticker)], args=[ticker, minute, volume, turnover, last_price],
+        client=pipe,
+    )
+
+
+async def read_tickers(r) -> dict[str, dict]:
+    """Сводка по всем тикерам одним HGETALL: тикер -> поле -> значение."""
+    summary = {}
+    for field, value in (await r.hgetall(TICKERS_KEY)).items():
+        ticker, name = field.split(':')
+        summary.setdefault(ticker, {})[name] = int(value)
+    return summary
+
+
+async def read_depth(r, ticker: str, limit: int) -> tuple[list, list, int]:
+    """Лучшие limit уровней каждой стороны [(цена, объём)], одним запросом и без агрегации на клиенте,
+    и номер diff маркет-даты, которому соответствует снимок."""
+    script = get_read_depth_script(r)
+    asks, bids, seq = await script(
+        keys=[*depth_keys(ticker, 'asks'), *depth_keys(ticker, 'bids'), md_seq_key(ticker)], args=[limit]
+    )
+
+    def pairs(levels):
+        return [(int(levels[i]), int(levels[i + 1])) for i in range(0, len(levels), 2)]
+
+    return pairs(asks), pairs(bids), seq
+
+
+async def cancel_in_book(r, ticker: str, order_uuids: list) -> list[str | None]:
+    """Снимает заявки тикера со стакана в Redis, возвращает их записи индекса (None - заявки уже нет)."""
+    script = get_cancel_script(r)
+    entries = await script(
+        keys=[ORDER_INDEX, f"orderbook:{ticker}:asks", f"orderbook:{ticker}:bids", f"orderbook:{ticker}:volume",
+              *depth_keys(ticker, 'asks'), *depth_keys(ticker, 'bids'), md_seq_key(ticker), TICKERS_KEY,
+              *[cancel_result_key(order_uuid) for order_uuid in order_uuids]],
+        args=[RESULT_TTL, md_channel(ticker), ticker, *[str(order_uuid) for order_uuid in order_uuids]],
+    )
+    return [entry or None for entry in entries]
+
+
+async def commit_match(r, ticker: str, side: str, order_uuid, result: dict, resting: RestingOrder | None = None,
+                       owner=None):
+    """Одним EVALSHA применяет результат матчинга заявки: сделки и остаток в стакан.
+    result - total_cost, matched_orders и remaining_qty, сохраняется до расчёта заявки в БД.
+    owner - владелец заявки, нужен для записи остатка в индекс."""
+    matched_orders = result["matched_orders"]
+    own, opposite = ('bids', 'asks') if side == 'BUY' else ('asks', 'bids')
+    args = [len(matched_orders)]
+    for item in matched_orders:
+        price = int(item["price"])
+        old_entry = f"{price}:{int(item['original_qty'])}:{item['uuid']}:{item['seq']}"
+        remaining_qty = item["original_qty"] - item["quantity"]
+        new_entry = f"{price}:{int(remaining_qty)}:{item['uuid']}:{item['seq']}" if remaining_qty > 0 else ''
+        # score не меняется, поэтому частично исполненная заявка сохраняет место в очереди
+        args += [old_entry, new_entry, book_score(opposite, price, item["seq"]), item["uuid"]]
+    if resting:
+        args += [resting.member, book_score(own, resting.price, resting.seq), resting.uuid, resting.seq,
+                 resting.qty]
+    else:
+        args += ['', 0, '', 0, 0]
+    args += [opposite, own, sum(item["quantity"] for item in matched_orders), json.dumps(result), RESULT_TTL,
+             index_entry(ticker, own, owner, resting.member) if resting else '', md_channel(ticker), ticker]
+
+    script = get_commit_match_script(r)
+    applied, detail = await script(
+        keys=[f"orderbook:{ticker}:{opposite}", f"orderbook:{ticker}:{own}", ORDER_INDEX,
+              f"orderbook:{ticker}:seq", f"orderbook:{ticker}:volume", match_result_key(order_uuid),
+              *depth_keys(ticker, opposite), *depth_keys(ticker, own), md_seq_key(ticker), TICKERS_KEY],
+        args=args,
+    )
+    if applied == 2:
+        # команду уже применили раньше, стакан в памяти сматчил её второй раз
+        raise BookConflict(f"order {order_uuid} is already matched")
+    if not applied:
+        raise BookConflict(f"order {detail} is missing in orderbook:{ticker}:{opposite}")
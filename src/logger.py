@@ -1,24 +1,66 @@
+import atexit
 import json
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import queue
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 from pathlib import Path
 
+# атрибуты, которые есть у любой записи: всё остальное в record.__dict__ пришло из extra
+STANDARD_ATTRS = frozenset(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
 
 class CustomFormatter(logging.Formatter):
-    def format(self, record):
-        base_message = super().format(record)
+    """Одна запись - одна строка компактного JSON, поля из extra на верхнем уровне."""
 
-        standard_attrs = logging.LogRecord('', '', '', 0, '', (), None).__dict__.keys()
-        extras = {
-            k: v for k, v in record.__dict__.items()
-            if k not in standard_attrs
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
         }
+        data.update((k, v) for k, v in record.__dict__.items() if k not in STANDARD_ATTRS)
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    # стандартный prepare форматирует сообщение и traceback в вызывающем потоке;
+    # очередь внутри процесса, поэтому запись можно передать как есть и форматировать в потоке записи
+    def prepare(self, record):
+        return record
+
+
+class LoggerRouter(logging.Handler):
+    """Обработчики всех логгеров процесса за одной очередью: запись уходит обработчикам своего логгера."""
 
-        if extras:
-            extra_str = json.dumps(extras, ensure_ascii=False)
-            return f"{base_message} | extra: {extra_str}"
-        else:
-            return base_message
+    def __init__(self):
+        super().__init__()
+        self.routes: dict[str, list[logging.Handler]] = {}
+
+    def handle(self, record):
+        for handler in self.routes.get(record.name, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        return True
+
+
+# логгеры только кладут запись в очередь, форматирование и запись на диск - в одном фоновом потоке,
+# так что задержки диска не попадают в event loop
+_queue = queue.SimpleQueue()
+_router = LoggerRouter()
+_listener = QueueListener(_queue, _router)
+_listener.start()
+atexit.register(_listener.stop)
+
+
+def add_queued_handler(logger: logging.Logger, handler: logging.Handler):
+    """Подключает handler к логгеру через общую очередь."""
+    handlers = _router.routes.setdefault(logger.name, [])
+    if not handlers:
+        logger.addHandler(LazyQueueHandler(_queue))
+    handlers.append(handler)
 
 
 LOG_DIR = Path("logs")
@@ -26,8 +68,7 @@ LOG_DIR = Path("logs")
 DATABASE_LOG_FILE = LOG_DIR / "database.log"
 API_LOG_FILE = LOG_DIR / "api.log"
 CACHE_LOG_FILE = LOG_DIR / "cache.log"
-
-LOG_FORMAT = '%(levelname)s: %(name)s - %(message)s - %(asctime)s'
+MATCHER_LOG_FILE = LOG_DIR / "matcher.log"
 
 
 def setup_logger(name: str, log_file: Path, level: int = logging.INFO, to_console: bool = False) -> logging.Logger:
@@ -35,18 +76,18 @@ def setup_logger(name: str, log_file: Path, level: int = logging.INFO, to_consol
     logger.setLevel(level)
     logger.propagate = False  # Не передавать логи родителям
 
-    formatter = CustomFormatter(LOG_FORMAT)
+    formatter = CustomFormatter()
 
     file_handler = TimedRotatingFileHandler(
         log_file, when="D", interval=1, backupCount=2, encoding="utf-8"
     )
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    add_queued_handler(logger, file_handler)
 
     if to_console:
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
+        add_queued_handler(logger, console_handler)
 
     return logger
 
@@ -54,3 +95,4 @@ def setup_logger(name: str, log_file: Path, level: int = logging.INFO, to_consol
 database_logger = setup_logger('database', DATABASE_LOG_FILE)
 api_logger = setup_logger('api', API_LOG_FILE)
 cache_logger = setup_logger('cache', CACHE_LOG_FILE)
+matcher_logger = setup_logger('matcher', MATCHER_LOG_FILE, to_console=True)
@@ -8,8 +8,12 @@ from starlette.middleware.cors import CORSMiddleware
 from src.middlewares.auth_middleware import AuthMiddleware
 from src.middlewares.log_middleware import LoggingMiddleware
 from src.redis_conn import redis_client
+from src.engine.results import result_waiter
+from src.engine.market_data import market_data_hub
 from src.api.v1 import router
 from src.utils.create import create_rub, create_admin_user
+from src.utils.instrument_registry import instrument_registry
+from src.utils.api_key_cache import api_key_cache
 
 api_key_header = APIKeyHeader(name="Authorization", auto_error=False, description=r"Форма записи TOKEN \<token\>")
 
@@ -22,8 +26,12 @@ async def lifespan(app: FastAPI):
     for _ in range(5):
         try:
             await redis_client.connect()
+            await result_waiter.start(await redis_client.get_redis())
+            await market_data_hub.start(await redis_client.get_redis())
+            await api_key_cache.start(await redis_client.get_redis())
             await create_rub()
             await create_admin_user()
+            await instrument_registry.start(await redis_client.get_redis())
             break
         except Exception as e:
             await asyncio.sleep(1)
@@ -31,6 +39,10 @@ async def lifespan(app: FastAPI):
     else:
         exit('Bad conection')
     yield
+    await result_waiter.stop()
+    await market_data_hub.stop()
+    await instrument_registry.stop()
+    await api_key_cache.stop()
     await redis_client.close()
 app = FastAPI(
     lifespan=lifespan,
@@ -1,13 +1,13 @@
 import json
 
-from fastapi import Request
-from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from src.db.db import async_session_maker
 from src.redis_conn import redis_client
 from src.db.userManager import usersManager
 from src.schemas.user import UserRedis
+from src.utils.api_key_cache import api_key_cache
 from src.utils.redis_utils import load_user_redis
 
 
@@ -17,48 +17,71 @@ async def validate_token(token):
     return user
 
 
-class AuthMiddleware(BaseHTTPMiddleware):
-
-    async def dispatch(self, request: Request, call_next):
-        if ("/public/" in request.url.path
-                or request.url.path.endswith("/docs")
-                or request.url.path.endswith("/openapi.json")):
-            return await call_next(request)
-        request_id = request.state.request_id
-        auth_header = request.headers.get("Authorization")
+class AuthMiddleware:
+    """ASGI-middleware: проверяет API-ключ и кладёт пользователя в scope["state"] (request.state.user)."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+        if ("/public/" in path
+                or path.endswith("/docs")
+                or path.endswith("/openapi.json")):
+            await self.app(scope, receive, send)
+            return
+        response = await self.authenticate(scope)
+        if response is not None:
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    async def authenticate(scope: Scope) -> JSONResponse | None:
+        state = scope.setdefault("state", {})
+        request_id = state.get("request_id")
+        auth_header = next((value.decode("latin-1") for name, value in scope["headers"]
+                            if name == b"authorization"), None)
         if not auth_header or not auth_header.startswith("TOKEN "):
             return JSONResponse({"detail": "Missing or invalid token"}, status_code=401)
 
         token = auth_header.split(" ")[1]
 
         if len(token) != 64:
-            print('/')
-            return JSONResponse({"detail": "Missing or invalid token"}, status_code=401)
-
-        try:
-            if userJson := await validate_token(token):
-                user = json.loads(userJson)
-            else:
-                async with async_session_maker() as session:
-                    user = await usersManager.get_user_apikey(token, session)
-                    await session.close()
-                    if not user:
-                        return JSONResponse({"detail": "Missing or invalid token"}, status_code=401)
-                    else:
-                        user = await load_user_redis(user.api_key, user, request_id)
-
-
-        except Exception as e:
             return JSONResponse({"detail": "Missing or invalid token"}, status_code=401)
 
-        user = UserRedis.model_validate(user, from_attributes=True)
+        # горячие ключи проверяются без Redis: уже провалидированный пользователь из памяти процесса
+        user = api_key_cache.get(token)
+        if user is None:
+            generation = api_key_cache.generation
+            try:
+                if userJson := await validate_token(token):
+                    user = json.loads(userJson)
+                else:
+                    async with async_session_maker() as session:
+                        user = await usersManager.get_user_apikey(token, session)
+                        await session.close()
+                        if not user:
+                            return JSONResponse({"detail": "Missing or invalid token"}, status_code=401)
+                        else:
+                            user = await load_user_redis(user.api_key, user, request_id)
+
+
+            except Exception as e:
+                return JSONResponse({"detail": "Missing or invalid token"}, status_code=401)
+
+            user = UserRedis.model_validate(user, from_attributes=True)
+            api_key_cache.put(token, user, generation)
 
         if not user.is_active:
             return JSONResponse({"detail": "User is not active"}, status_code=401)
 
-        if ('/admin/' in request.url.path
+        if ('/admin/' in scope["path"]
                 and user.role != 'ADMIN'):
             return JSONResponse({"detail": "FORBIDDEN"}, status_code=403)
 
-        request.state.user = user
-        return await call_next(request)
+        state["user"] = user
+        return None
@@ -2,10 +2,10 @@ import uuid
 import json
 import os
 import logging
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
-from starlette.responses import Response
-from starlette.types import Message
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.logger import add_queued_handler
 
 LOG_DIR = "logs"
 LOG_FILE = "requests.log"
@@ -13,6 +13,7 @@ os.makedirs(LOG_DIR, exist_ok=True)
 
 logger = logging.getLogger("request_logger")
 logger.setLevel(logging.INFO)
+logger.propagate = False
 
 file_handler = logging.FileHandler(os.path.join(LOG_DIR, LOG_FILE), encoding="utf-8")
 
@@ -20,63 +21,92 @@ formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] %(message)s")
 file_handler.setFormatter(formatter)
 
 if not logger.handlers:
-    logger.addHandler(file_handler)
-
-# Старое логирование всего и чек для тестов
-# что бы понять где что падает
-class LoggingMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        request_id = str(uuid.uuid4())
-        request.state.request_id = request_id
-
-        method = request.method
-        path = request.url.path
+    add_queued_handler(logger, file_handler)
 
-        if (path == '/api/v1/order' or
-                path.startswith('/api/v1/public/orderbook') or
-                path == "/api/v1/balance" or
-                path == '/api/v1/admin/balance/deposit'):
+# в лог попадает только начало тела запроса и ответа, сами тела проходят без копирования
+LOG_BODY_LIMIT = 1024
 
-            body_bytes = await request.body()
-            body_str = body_bytes.decode("utf-8", errors="ignore")
 
-            try:
-                parsed_body = json.loads(body_str)
-            except Exception:
-                parsed_body = body_str
+def is_logged(path: str) -> bool:
+    return (path == '/api/v1/order' or
+            path.startswith('/api/v1/public/orderbook') or
+            path == "/api/v1/balance" or
+            path == '/api/v1/admin/balance/deposit')
 
-            logger.info(
-                f"[{request_id}] ➡️ {method} {path} | Body: {parsed_body if method in ['POST', 'DELETE'] else 'N/A'}")
 
-            async def receive() -> Message:
-                return {"type": "http.request", "body": body_bytes}
+class LazyBody:
+    # тело разбирается, только когда запись форматируется в потоке логирования
+    __slots__ = ('body',)
 
-            request._receive = receive
+    def __init__(self, body: bytes):
+        self.body = body
 
-            try:
-                response: Response = await call_next(request)
+    def __str__(self):
+        try:
+            return str(json.loads(self.body))
+        except Exception:
+            return self.body[:300].decode("utf-8", errors="ignore")
 
-                response_body = b""
-                async for chunk in response.body_iterator:
-                    response_body += chunk
 
-                new_response = Response(
-                    content=response_body,
-                    status_code=response.status_code,
-                    headers=dict(response.headers),
-                    media_type=response.media_type
-                )
-                new_response.headers["X-Request-ID"] = request_id
+# Старое логирование всего и чек для тестов
+# что бы понять где что падает
+class LoggingMiddleware:
+    """ASGI-middleware: request_id в scope["state"] (request.state.request_id) и заголовок X-Request-ID
+    в каждом ответе, а для путей is_logged - запрос и ответ в requests.log."""
 
-                try:
-                    parsed_response = json.loads(response_body.decode("utf-8"))
-                except Exception:
-                    parsed_response = response_body[:300].decode("utf-8", errors="ignore")
+    def __init__(self, app: ASGIApp):
+        self.app = app
 
-                logger.info(f"[{request_id}] ⬅️ {response.status_code} | Response: {parsed_response}")
-                return new_response
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
-            except Exception as e:
-                logger.error(f"[{request_id}] ❌ Exception: {repr(e)}")
-                raise
-        return await call_next(request)
+        request_id = str(uuid.uuid4())
+        scope.setdefault("state", {})["request_id"] = request_id
+        header = (b"x-request-id", request_id.encode())
+
+        method, path = scope["method"], scope["path"]
+        if not is_logged(path):
+            async def send_with_id(message: Message):
+                if message["type"] == "http.response.start":
+                    message["headers"] = [*message.get("headers", []), header]
+                await send(message)
+
+            await self.app(scope, receive, send_with_id)
+            return
+
+        request_body = bytearray()
+        response_body = bytearray()
+        status_code = None
+
+        def log_request():
+            logger.info("[%s] ➡️ %s %s | Body: %s", request_id, method, path,
+                        LazyBody(bytes(request_body)) if method in ['POST', 'DELETE'] else 'N/A')
+
+        async def receive_logged() -> Message:
+            message = await receive()
+            if message["type"] == "http.request" and len(request_body) < LOG_BODY_LIMIT:
+                request_body.extend(message.get("body", b"")[:LOG_BODY_LIMIT - len(request_body)])
+            return message
+
+        async def send_logged(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = [*message.get("headers", []), header]
+                log_request()
+            elif message["type"] == "http.response.body":
+                if len(response_body) < LOG_BODY_LIMIT:
+                    response_body.extend(message.get("body", b"")[:LOG_BODY_LIMIT - len(response_body)])
+                if not message.get("more_body", False):
+                    logger.info("[%s] ⬅️ %s | Response: %s", request_id, status_code, LazyBody(bytes(response_body)))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_logged, send_logged)
+        except Exception as e:
+            if status_code is None:
+                log_request()
+            logger.error("[%s] ❌ Exception: %r", request_id, e)
+            raise
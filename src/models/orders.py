@@ -2,7 +2,7 @@ import enum
 from datetime import datetime
 
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import ForeignKey, Enum, UUID, func
+from sqlalchemy import ForeignKey, Enum, UUID, func, Index
 
 from src.models.base import Base
 
@@ -48,4 +48,11 @@ class Orders(Base):
 
     @property
     def ticker(self):
-        return self.instrument.ticker
\ No newline at end of file
+        return self.instrument.ticker
+
+
+# список заявок пользователя читается от новых к старым, keyset-пагинация по (create_at, uuid):
+# с фильтром по статусу и без него
+Index('ix_orders_user_status_create_at', Orders.user_uuid, Orders.status, Orders.create_at.desc(),
+      Orders.uuid.desc())
+Index('ix_orders_user_create_at', Orders.user_uuid, Orders.create_at.desc(), Orders.uuid.desc())
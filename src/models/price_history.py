@@ -1,13 +1,25 @@
-from sqlalchemy import ForeignKey
+from datetime import datetime
+
+from sqlalchemy import ForeignKey, String, TIMESTAMP, UniqueConstraint
 
 from src.models.base import Base
 from sqlalchemy.orm import Mapped, mapped_column
 
-# не актуальная таблица
+
+# OHLCV-бары тикера, пишутся воркером матчинга пачками (src/engine/candles.py)
 class PriceHistory(Base):
     __tablename__ = 'price_history'
+    __table_args__ = (
+        # он же индекс для чтения истории баров тикера по интервалу
+        UniqueConstraint('instrument_id', 'interval', 'bucket', name='uq_price_history_bar'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     instrument_id: Mapped[int] = mapped_column(ForeignKey('instruments.id'), nullable=False)
-    price: Mapped[float] = mapped_column(nullable=False)
-
+    interval: Mapped[str] = mapped_column(String(3), nullable=False)
+    bucket: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=False)
+    open: Mapped[float] = mapped_column(nullable=False)
+    high: Mapped[float] = mapped_column(nullable=False)
+    low: Mapped[float] = mapped_column(nullable=False)
+    close: Mapped[float] = mapped_column(nullable=False)
+    volume: Mapped[int] = mapped_column(nullable=False)
@@ -1,4 +1,4 @@
-from sqlalchemy import ForeignKey, UUID, String
+from sqlalchemy import ForeignKey, UUID, String, Index
 
 from src.models.base import Base
 from sqlalchemy.orm import Mapped, mapped_column, relationship
@@ -11,8 +11,12 @@ class TradeLog(Base):
     sell_order_id: Mapped[UUID] = mapped_column(ForeignKey('orders.uuid'))
     price: Mapped[float] = mapped_column(nullable=False)
     quantity: Mapped[int] = mapped_column(nullable=False)
-    ticker: Mapped[str] = mapped_column(String(10), nullable=False, index=True)
+    ticker: Mapped[str] = mapped_column(String(10), nullable=False)
 
     buy_order = relationship("Orders", back_populates="buy_trades", foreign_keys=[buy_order_id])
     sell_order = relationship("Orders", back_populates="sell_trades", foreign_keys=[sell_order_id])
-    user_trade_history = relationship("UserTradeHistory", back_populates="trade")
\ No newline at end of file
+    user_trade_history = relationship("UserTradeHistory", back_populates="trade")
+
+
+# история сделок тикера читается от новых к старым, keyset-пагинация по (create_at, id)
+Index('ix_trade_log_ticker_create_at_id', TradeLog.ticker, TradeLog.create_at.desc(), TradeLog.id.desc())
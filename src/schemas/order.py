@@ -1,20 +1,34 @@
 from datetime import datetime
+from typing import Annotated
 
 from pydantic import BaseModel, Field, ConfigDict, UUID4
+from pydantic_core import to_json
 
+from src.engine.orderbook import MAX_PRICE
 from src.models.orders import SideEnum, StatusEnum
 
-def create_GetOrder(orderOrm):
-    body = Body.model_validate(orderOrm, from_attributes=True)
-    order = GetOrder.model_validate(
-        {
-            **orderOrm.__dict__,
-            "body": body
-        },
-        from_attributes=True
-    )
+def order_to_dict(row, ticker: str | None = None) -> dict:
+    """Строка orderManager.select_order_rows -> ответ в форме GetOrder.model_dump(exclude_none=True),
+    без валидации модели. ticker - для строк без него (RETURNING расчёта и отмены)."""
+    body = {"direction": row.side.value, "ticker": ticker or row.ticker, "qty": row.qty}
+    if row.price is not None:
+        body["price"] = int(row.price)
+    order = {"id": row.uuid, "status": row.status.value, "user_id": row.user_uuid, "timestamp": row.create_at.isoformat(),
+             "body": body}
+    if row.filled is not None:
+        order["filled"] = row.filled
     return order
 
+
+def orders_json(rows) -> bytes:
+    # to_json кодирует UUID и enum так же, как FastAPI, но сразу в bytes
+    return to_json([order_to_dict(row) for row in rows])
+
+
+def order_json(row, ticker: str | None = None) -> bytes:
+    return to_json(order_to_dict(row, ticker))
+
+
 class OrderBase(BaseModel):
     direction: SideEnum
     qty: int = Field(..., ge=1)
@@ -26,7 +40,11 @@ class MarketOrder(OrderBase):
 
 
 class LimitOrder(OrderBase):
-    price: int = Field(..., gt=0)
+    # выше MAX_PRICE score стакана в Redis теряет точность и ломает приоритет по времени
+    price: int = Field(..., gt=0, lt=MAX_PRICE)
+
+
+OrdersBatch = Annotated[list[LimitOrder | MarketOrder], Field(min_length=1, max_length=1000)]
 
 
 class Body(BaseModel):
@@ -1,26 +1,253 @@
 import sys
 from pathlib import Path
 import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import time
+import uuid
 
 project_root = Path(__file__).parent.parent.parent
 sys.path.append(str(project_root))
 
-from src.tasks.orders import match_order_limit
+from redis.exceptions import ResponseError
+
+from src.config import settings
+from src.engine import MatchingEngine
+from src.engine.candles import candle_aggregator
+from src.engine.commands import ORDERS_GROUP, DEAD_LETTER_STREAM, partition_stream, partition_of
+from src.engine.partitions import PartitionMembership, HEARTBEAT_INTERVAL
+from src.engine.scripts import match_result_key, cancel_result_key, record_trades
+from src.logger import matcher_logger
+from src.tasks.orders import match_order, cancel_resting_orders, reject_order
+from src.utils.instrument_registry import instrument_registry
 from src.redis_conn import redis_client
 
+# сколько записей забирать из стрима за одно чтение и за один шаг XAUTOCLAIM
+READ_COUNT = 16
+CLAIM_COUNT = 100
+# упавшая команда повторяется до MAX_ATTEMPTS раз, пауза начинается с RETRY_DELAY сек и удваивается;
+# после этого команда уходит в DEAD_LETTER_STREAM, чтобы не держать остальные тикеры партиции
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 0.5
+DEAD_LETTER_MAXLEN = 10000
 
-async def main():
-    r = await redis_client.get_redis()
-    while True:
-        if value := await r.rpop("limit_orders"):
-            uuid_order, ticker, request_id = value.split(':')
+
+async def handle_command(fields: dict, engine: MatchingEngine, r):
+    action, uuid_order, ticker, request_id = fields['action'], fields['order_id'], fields['ticker'], fields['request_id']
+    if action == 'cancel':
+        # в одной команде отмены может быть несколько заявок тикера через запятую
+        await cancel_resting_orders(uuid_order.split(','), ticker, request_id, engine, r)
+    else:
+        await match_order(uuid_order, ticker, request_id, engine, r)
+
+
+async def ensure_group(r, stream: str):
+    try:
+        # id=0: заявки, добавленные до создания группы, тоже будут прочитаны
+        await r.xgroup_create(stream, ORDERS_GROUP, id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+class MatcherWorker:
+    """Воркер матчинга: читает стримы своих партиций через consumer group.
+
+    Запись подтверждается XACK только после того, как заявка рассчитана, поэтому команда,
+    на которой воркер упал, остаётся в pending и забирается новым владельцем партиции через XAUTOCLAIM."""
+
+    def __init__(self, r, worker_id: str):
+        self.r = r
+        self.worker_id = worker_id
+        # владелец стаканов тикеров своих партиций: все изменения этих книг идут через него
+        self.engine = MatchingEngine()
+        self.membership = PartitionMembership(r, worker_id)
+        self.next_heartbeat = 0
+        self.next_roll = 0
+
+    async def heartbeat(self):
+        if time.monotonic() < self.next_heartbeat:
+            return
+        await self.flush_candles()
+        acquired, lost = await self.membership.heartbeat()
+        self.next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+        for partition in lost:
+            self.engine.drop_partition(partition)
+            candle_aggregator.drop_partition(partition)
+        for partition in sorted(acquired):
+            await ensure_group(self.r, partition_stream(partition))
+            await self.reclaim(partition)
+        await self.roll_tickers()
+
+    async def roll_tickers(self):
+        # раз в минуту сдвигаем окно 24 часов сводки и для тикеров без сделок. Тикеры берутся из реестра,
+        # а не из engine.books: после перезапуска или переезда партиции стакан простаивающего тикера
+        # не загружен, а его объём за 24 часа всё равно должен уменьшаться
+        if time.time() < self.next_roll or not self.membership.owned:
+            return
+        self.next_roll = time.time() + 60
+        pipe = self.r.pipeline(transaction=False)
+        for ticker in instrument_registry.ids:
+            if partition_of(ticker) in self.membership.owned:
+                await record_trades(self.r, pipe, ticker, int(time.time()) // 60)
+        await pipe.execute()
+
+    async def flush_candles(self):
+        # свечи - производные от trade_log данные, сбой записи не должен останавливать матчинг
+        try:
+            await candle_aggregator.flush(self.r)
+        except Exception as e:
+            print(f"candles flush failed: {e}")
+
+    async def reclaim(self, partition: int):
+        # аренда партиции у нас, значит прежний владелец отпустил её или не продлевал дольше LEASE_TTL_MS
+        # (аренда продлевается и во время команды): его неподтверждённые записи забираем сразу
+        stream = partition_stream(partition)
+        start = '0-0'
+        while True:
+            start, entries, *_ = await self.r.xautoclaim(stream, ORDERS_GROUP, self.worker_id, 0,
+                                                         start_id=start, count=CLAIM_COUNT)
+            for entry_id, fields in entries:
+                if fields and not await self.process(stream, entry_id, fields):
+                    return
+            if start == '0-0':
+                break
+
+    async def keep_leases(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
             try:
-                await match_order_limit(uuid_order, ticker, request_id, r)
+                held = await self.membership.renew()
             except Exception as e:
-                print(e)
-            finally:
-                print('finished')
+                print(f"lease renew failed: {e}")
+                continue
+            if held != self.membership.owned:
+                print(f"leases lost during command: {sorted(self.membership.owned - held)}")
+
+    async def run_command(self, fields: dict):
+        # heartbeat между записями не вызывается, пока команда выполняется: без продления аренда
+        # долгой команды истечёт, и новый владелец партиции заберёт ту же запись через XAUTOCLAIM
+        keeper = asyncio.create_task(self.keep_leases())
+        try:
+            await handle_command(fields, self.engine, self.r)
+        finally:
+            keeper.cancel()
+
+    async def process(self, stream: str, entry_id: str, fields: dict) -> bool:
+        """Выполняет команду и подтверждает её. Упавшая команда повторяется с нарастающей паузой:
+        следующие записи тикера не обрабатываются раньше неё, а после MAX_ATTEMPTS она уходит в dead-letter.
+        False - партиция ушла другому воркеру, команда осталась в pending для нового владельца."""
+        delay = RETRY_DELAY
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                await self.run_command(fields)
+                break
+            except Exception as e:
+                matcher_logger.error("[%s] %s %s failed, attempt %s of %s", fields['request_id'], fields['action'],
+                                     fields['order_id'], attempt, MAX_ATTEMPTS, exc_info=e)
+                if attempt == MAX_ATTEMPTS:
+                    await self.dead_letter(stream, entry_id, fields, e)
+                    return True
+            await asyncio.sleep(delay)
+            delay *= 2
+            await self.heartbeat()
+            if partition_of(fields['ticker']) not in self.membership.owned:
+                return False
+        result_key = cancel_result_key if fields['action'] == 'cancel' else match_result_key
+        pipe = self.r.pipeline()
+        pipe.xack(stream, ORDERS_GROUP, entry_id)
+        pipe.xdel(stream, entry_id)
+        pipe.delete(*[result_key(order_uuid) for order_uuid in fields['order_id'].split(',')])
+        await pipe.execute()
+        return True
+
+    async def dead_letter(self, stream: str, entry_id: str, fields: dict, error: Exception):
+        # сохранённые результаты (что уже сделано в стакане Redis) не удаляются и копируются в запись:
+        # по ним команду можно довести вручную
+        order_uuids = fields['order_id'].split(',')
+        result_key = cancel_result_key if fields['action'] == 'cancel' else match_result_key
+        results = await self.r.mget([result_key(order_uuid) for order_uuid in order_uuids])
+        pipe = self.r.pipeline()
+        pipe.xadd(DEAD_LETTER_STREAM, {
+            **fields, "stream": stream, "entry_id": entry_id, "error": repr(error),
+            "results": json.dumps(dict(zip(order_uuids, results))),
+        }, maxlen=DEAD_LETTER_MAXLEN, approximate=True)
+        pipe.xack(stream, ORDERS_GROUP, entry_id)
+        pipe.xdel(stream, entry_id)
+        await pipe.execute()
+        matcher_logger.error("[%s] %s %s moved to %s", fields['request_id'], fields['action'], fields['order_id'],
+                             DEAD_LETTER_STREAM)
+
+        if fields['action'] == 'cancel':
+            # заявки остаются активными, пользователь может отменить их снова
+            return
+        try:
+            # заявка не должна навсегда остаться NEW: отменяем, если стакан Redis её ещё не видел
+            if not await reject_order(fields['order_id'], fields['ticker'], 'processing failed', self.r):
+                matcher_logger.error("[%s] order %s left for manual recovery", fields['request_id'],
+                                     fields['order_id'])
+        except Exception as e:
+            matcher_logger.error("[%s] reject order %s failed", fields['request_id'], fields['order_id'], exc_info=e)
+
+    async def run(self):
+        try:
+            while True:
+                await self.heartbeat()
+                if not self.membership.owned:
+                    await asyncio.sleep(HEARTBEAT_INTERVAL)
+                    continue
+
+                # блокирующее чтение: без заявок воркер спит в Redis до HEARTBEAT_INTERVAL
+                response = await self.r.xreadgroup(
+                    ORDERS_GROUP, self.worker_id,
+                    {partition_stream(p): '>' for p in sorted(self.membership.owned)},
+                    count=READ_COUNT, block=HEARTBEAT_INTERVAL * 1000,
+                )
+                # записи одной партиции обрабатываются строго по очереди, это сохраняет порядок по тикеру
+                for stream, entries in response or []:
+                    for entry_id, fields in entries:
+                        await self.heartbeat()
+                        if (partition_of(fields['ticker']) not in self.membership.owned
+                                or not await self.process(stream, entry_id, fields)):
+                            # партиция ушла, остаток пачки заберёт новый владелец
+                            break
+        finally:
+            await self.flush_candles()
+            await self.membership.leave()
+
+
+async def worker_main(worker_id: str):
+    r = await redis_client.get_redis()
+    # RUB и тикер каждого расчёта разрешаются из памяти процесса
+    await instrument_registry.start(r)
+    await MatcherWorker(r, worker_id).run()
+
+
+def run_worker(worker_id: str):
+    asyncio.run(worker_main(worker_id))
+
+
+def main():
+    # супервизор: держит MATCHER_WORKERS процессов и перезапускает упавшие,
+    # партиции между ними перераспределяются через PartitionMembership
+    workers_count = settings.MATCHER_WORKERS or os.cpu_count() or 1
+    ctx = multiprocessing.get_context('spawn')
+    processes = {}
+    while True:
+        for slot in range(workers_count):
+            process = processes.get(slot)
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                print(f"matcher worker {slot} exited with code {process.exitcode}, restarting")
+            worker_id = f"{socket.gethostname()}:{slot}:{uuid.uuid4().hex[:8]}"
+            process = ctx.Process(target=run_worker, args=(worker_id,), daemon=True)
+            process.start()
+            processes[slot] = process
+        time.sleep(HEARTBEAT_INTERVAL)
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    main()
@@ -1,150 +1,320 @@
 import json
-from datetime import timezone
+from collections import defaultdict
+from datetime import datetime, timezone
+from uuid import UUID
+
+from sqlalchemy import insert
+
 from src.db.db import async_session_maker
+from src.db.orderManager import orderManager
 from src.db.userManager import usersManager
 from src.models import Orders, TradeLog
 from src.models.orders import StatusEnum, TypeEnum, SideEnum
+from src.engine import MatchingEngine, OrderBook, RestingOrder
+from src.engine.candles import candle_aggregator
+from src.engine.index import parse_index_entry
+from src.engine.results import publish_result
+from src.engine.scripts import (BookConflict, commit_match, cancel_in_book, get_result, get_results,
+                                match_result_key, cancel_result_key, md_channel, record_trades)
+from src.logger import matcher_logger
 from src.redis_conn import redis_client
-from src.utils.redis_utils import match_limit_order, update_match_orders
+from src.utils.balance_cache import balance_cache
+from src.utils.order_cache import cache_orders
+from src.utils.redis_utils import check_ticker_exists
 
 
 async def execution_orders(orderOrm: Orders, ticker, userRub,
                            userTicker, matched_orders,
-                           total_cost, session, redis_c, remaining_qty_order=None):
-    # быстрый update смаченных ордеров
-    pipe = redis_c.pipeline()
-    update_match_orders(pipe, matched_orders, ticker, orderOrm.side)
-    await pipe.execute()
+                           total_cost, session, redis_c, remaining_qty_order=0):
+    """Рассчитывает результат матчинга заявки одной транзакцией: заявки стакана, балансы и сделки
+    пишутся пачкой, число запросов не зависит от количества сделок."""
+    # стакан в Redis к этому моменту уже обновлён через commit_match
+    rub_id, ticker_id = userRub.instrument_id, userTicker.instrument_id
+    # (user_uuid, instrument_id) -> [приращение available, приращение frozen]
+    deltas = defaultdict(lambda: [0, 0])
 
-    if orderOrm.order_type == TypeEnum.MARKET_ORDER:
-        if orderOrm.side == SideEnum.SELL:
-            userRub.available_balance += total_cost
-            userTicker.available_balance -= orderOrm.qty
-        else:
-            userRub.available_balance -= total_cost
-            userTicker.available_balance += orderOrm.qty
-    else:
-        if orderOrm.side == SideEnum.SELL:
-            userRub.available_balance += total_cost
-            userTicker.available_balance -= (orderOrm.qty - remaining_qty_order)
+    # отметка о расчёте коммитится вместе с ним: лимитная заявка без сделок остаётся NEW,
+    # и повторно доставленная команда отличает её от ещё не рассчитанной только по activation_time
+    orderOrm.activation_time = datetime.now()
+    filled_qty = orderOrm.qty - remaining_qty_order
+    sign = 1 if orderOrm.side == SideEnum.SELL else -1
+    deltas[(orderOrm.user_uuid, rub_id)][0] += sign * total_cost
+    deltas[(orderOrm.user_uuid, ticker_id)][0] -= sign * filled_qty
 
+    # неисполненный остаток лимитной заявки замораживается до следующих сделок
+    if remaining_qty_order:
+        if orderOrm.side == SideEnum.BUY:
+            reserved = remaining_qty_order * orderOrm.price
+            deltas[(orderOrm.user_uuid, rub_id)][0] -= reserved
+            deltas[(orderOrm.user_uuid, rub_id)][1] += reserved
         else:
-            userRub.available_balance -= total_cost
-            userTicker.available_balance += (orderOrm.qty - remaining_qty_order)
-    await session.commit()
-
-    pipe = redis_c.pipeline()
+            deltas[(orderOrm.user_uuid, ticker_id)][0] -= remaining_qty_order
+            deltas[(orderOrm.user_uuid, ticker_id)][1] += remaining_qty_order
 
+    filled_orders = await orderManager.fill_orders(
+        session, {UUID(item["uuid"]): item["quantity"] for item in matched_orders}
+    )
+    trades = []
     for item in matched_orders:
-        match_order_uuid = item.get("uuid")
-        price = item.get("price")
-        quantity = item.get("quantity")
-        total_cost = item.get("cost")
-
-        match_order = await session.get(Orders, match_order_uuid)
-
-        match_user_rub_balance = await usersManager.get_user_balance_by_ticker(
-            session, match_order.user_uuid, ticker="RUB", create_if_missing=True
-        )
-
-        match_user_ticker_balance = await usersManager.get_user_balance_by_ticker(
-            session, match_order.user_uuid, ticker=ticker, create_if_missing=True
-        )
-
+        match_order_uuid = UUID(item["uuid"])
+        match_user = filled_orders[match_order_uuid].user_uuid
         if orderOrm.side == SideEnum.SELL:
-            match_user_rub_balance.frozen_balance -= total_cost
-            match_user_ticker_balance.available_balance += quantity
-
+            deltas[(match_user, rub_id)][1] -= item["cost"]
+            deltas[(match_user, ticker_id)][0] += item["quantity"]
         else:
-            match_user_rub_balance.available_balance += total_cost
-            match_user_ticker_balance.frozen_balance -= quantity
+            deltas[(match_user, rub_id)][0] += item["cost"]
+            deltas[(match_user, ticker_id)][1] -= item["quantity"]
 
-        match_order.filled = (match_order.filled or 0) + quantity
-        if match_order.filled >= match_order.qty:
-            match_order.status = StatusEnum.EXECUTED
-        else:
-            match_order.status = StatusEnum.PARTIALLY_EXECUTED
+        trades.append({
+            "sell_order_id": orderOrm.uuid if orderOrm.side == SideEnum.SELL else match_order_uuid,
+            "buy_order_id": match_order_uuid if orderOrm.side == SideEnum.SELL else orderOrm.uuid,
+            "price": item["price"],
+            "quantity": item["quantity"],
+            "ticker": ticker,
+        })
 
+    users = {user_uuid for user_uuid, _ in deltas}
+    await balance_cache.begin(redis_c, users)
+    try:
+        await usersManager.apply_balance_deltas(session, deltas)
+        created_at = None
+        if trades:
+            created_at = (await session.execute(
+                insert(TradeLog).values(trades).returning(TradeLog.create_at)
+            )).scalar()
         await session.commit()
+    except Exception:
+        await balance_cache.abort(redis_c, users)
+        raise
+    await balance_cache.apply(redis_c, deltas)
 
-        trade = TradeLog(
-            sell_order_id=orderOrm.uuid if orderOrm.side == SideEnum.SELL else match_order_uuid,
-            buy_order_id=match_order_uuid if orderOrm.side == SideEnum.SELL else orderOrm.uuid,
-            price=price,
-            quantity=quantity,
-            ticker=ticker
+    if trades:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+        pipe = redis_c.pipeline()
+        for trade in trades:
+            add_tradeLog_redis(pipe, ticker, {
+                "ticker": ticker,
+                "amount": trade["quantity"],
+                "price": trade["price"],
+                "timestamp": created_at.isoformat(),
+            })
+        # все сделки расчёта в одной минуте: в сводку тикеров одним вызовом
+        await record_trades(redis_c, pipe, ticker, int(created_at.timestamp()) // 60,
+                            sum(trade["quantity"] for trade in trades),
+                            sum(int(trade["price"]) * trade["quantity"] for trade in trades),
+                            int(trades[-1]["price"]))
+        # статусы тейкера и исполненных заявок стакана для GET /order/{id}
+        cache_orders(pipe, [orderOrm, *filled_orders.values()], ticker)
+        await pipe.execute()
+        # в бары свечей, в БД они уйдут пачкой при следующем heartbeat воркера
+        await candle_aggregator.add_trades(
+            redis_c, ticker, ticker_id, [(trade["price"], trade["quantity"], created_at) for trade in trades]
         )
-        session.add(trade)
-        await session.commit()
-
-        add_tradeLog_redis(pipe, ticker, {
-            "ticker": ticker,
-            "amount": quantity,
-            "price": price,
-            "timestamp": trade.create_at.replace(tzinfo=timezone.utc).isoformat(),
-        })
-    await pipe.execute()
 
 
 def add_tradeLog_redis(pipe, ticker: str, data: dict):
     key = f"ticker:{ticker}"
     pipe.lpush(key, json.dumps(data))
     pipe.ltrim(key, 0, 199)
+    # та же сделка подписчикам маркет-даты
+    pipe.publish(md_channel(ticker), json.dumps({"type": "trade", **data}))
 
 
-async def match_order_limit(orderOrm_uuid, ticker: str, request_id, r=None):
+async def match_order(orderOrm_uuid, ticker: str, request_id, engine: MatchingEngine, r=None):
+    # команда из стрима может прийти повторно, поэтому всё, что уже сделано, пропускается
     try:
         if not r:
             r = await redis_client.get_redis()
         async with async_session_maker() as session:
             orderOrm = await session.get(Orders, orderOrm_uuid)
-            try:
-                userBalanceRUB = await usersManager.get_user_balance_by_ticker(
-                    session, orderOrm.user_uuid, 'RUB', create_if_missing=True
-                )
-
-                userBalanceTicker = await usersManager.get_user_balance_by_ticker(
-                    session, orderOrm.user_uuid, ticker=ticker, create_if_missing=True
-                )
-                total_cost, matched_orders, remaining_qty_order = await match_limit_order(r, ticker,
-                                                                                          orderOrm.qty, orderOrm.price,
-                                                                                          orderOrm.side.value)
-                if matched_orders:
-
-                    orderOrm.status = StatusEnum.EXECUTED if remaining_qty_order == 0 else StatusEnum.PARTIALLY_EXECUTED
-                    if orderOrm.status == StatusEnum.EXECUTED:
-                        orderOrm.filled = orderOrm.qty
-                    elif orderOrm.status == StatusEnum.PARTIALLY_EXECUTED:
-                        orderOrm.filled = orderOrm.qty - remaining_qty_order
-                    await execution_orders(
-                        orderOrm, ticker, userBalanceRUB, userBalanceTicker, matched_orders, total_cost, session, r,
-                        remaining_qty_order
-                    )
-                    await session.commit()
-            except Exception as e:
-                pass
-            try:
-                if orderOrm.side == SideEnum.BUY:
-                    # Списали уже реально потраченное в userBalanceRUB.available_balance -= total_cost выше
-                    # Теперь заморозить только остаток заявки на будущие сделки
-                    remaining_reserved = remaining_qty_order * orderOrm.price
-                    userBalanceRUB.frozen_balance += remaining_reserved
-                    userBalanceRUB.available_balance -= remaining_reserved
-                else:  # orderOrm.side == SideEnum.SELL:
-                    # Продажа: заморозить неисполненный объём
-                    userBalanceTicker.available_balance -= remaining_qty_order
-                    userBalanceTicker.frozen_balance += remaining_qty_order
-                if remaining_qty_order > 0:
-                    orderbook_key_add = f"orderbook:{ticker}:{'asks' if orderOrm.side == SideEnum.SELL else 'bids'}"
-                    timestamp = round(orderOrm.create_at.timestamp(), 3)
-                    new_entry_add = f"{int(orderOrm.price)}:{int(remaining_qty_order)}:{orderOrm.uuid}:{timestamp}"
-                    await r.zadd(orderbook_key_add, {new_entry_add: orderOrm.price})
-                    await r.hset('active_orders', str(orderOrm.uuid), "active")
+            if orderOrm is None or orderOrm.status != StatusEnum.NEW or orderOrm.activation_time is not None:
+                return
+            reason = None
+            for attempt in range(2):
+                book = await engine.get_book(r, ticker)
+                try:
+                    if orderOrm.order_type == TypeEnum.MARKET_ORDER:
+                        reason = await match_order_market(orderOrm, ticker, book, session, r, request_id)
+                    else:
+                        await match_order_limit(orderOrm, ticker, book, session, r)
+                    break
+                except BookConflict as e:
+                    # в БД ещё ничего не записано: перечитываем стакан из Redis и матчим заново,
+                    # после второго конфликта команда остаётся в pending
+                    engine.drop_book(ticker)
+                    matcher_logger.warning("[%s] %s", request_id, e)
+                    if attempt:
+                        raise
 
-                await session.commit()
-            except Exception as e:
-                pass
+            if orderOrm.order_type == TypeEnum.MARKET_ORDER:
+                # API ждёт исполнения рыночной заявки
+                await publish_result(r, orderOrm.uuid, orderOrm.status.value, orderOrm.filled, reason)
+
+    except Exception:
+        # стакан в памяти мог разойтись с Redis - перечитаем при следующем обращении,
+        # а команда останется неподтверждённой в стриме
+        engine.drop_book(ticker)
+        raise
 
-    except Exception as e:
-        await session.rollback()
-        print(e)
+
+async def reject_order(order_uuid, ticker: str, reason: str, r) -> bool:
+    """Отменяет заявку, команду которой матчер так и не выполнил. Только пока её сделки не записаны
+    в стакан Redis: после commit_match стакан и БД сводятся вручную, по записи в dead-letter."""
+    if await get_result(r, match_result_key(order_uuid)) is not None:
+        return False
+    async with async_session_maker() as session:
+        row = await orderManager.reject_order(session, UUID(str(order_uuid)))
+        await session.commit()
+    if row is None:
+        return False
+    pipe = r.pipeline(transaction=False)
+    cache_orders(pipe, [row], ticker)
+    await pipe.execute()
+    if row.order_type == TypeEnum.MARKET_ORDER:
+        await publish_result(r, row.uuid, StatusEnum.CANCELLED.value, row.filled, reason)
+    return True
+
+
+async def get_order_balances(session, orderOrm: Orders):
+    # RUB и тикер заявки одним запросом, id тикера уже есть в самой заявке
+    rub_id = await check_ticker_exists('RUB', session)
+    balances = await usersManager.get_user_balances(
+        session, orderOrm.user_uuid, [rub_id, orderOrm.instrument_id], create_if_missing=True
+    )
+    return balances[rub_id], balances[orderOrm.instrument_id]
+
+
+async def match_order_market(orderOrm: Orders, ticker: str, book: OrderBook, session, r, request_id) -> str | None:
+    """Исполняет рыночную заявку целиком или отменяет её, возвращает причину отмены."""
+    userBalanceRUB, userBalanceTicker = await get_order_balances(session, orderOrm)
+
+    result = await get_result(r, match_result_key(orderOrm.uuid))
+    if result is None:
+        # сначала оцениваем без изменения стакана, чтобы не откатывать его при отказе.
+        # При нехватке объёма отказываем по счётчику, не читая стакан
+        reason = None
+        if book.opposite_side(orderOrm.side.value).volume < orderOrm.qty:
+            reason = 'no liquidity'
+        else:
+            await MatchingEngine.ensure_liquidity(r, book, orderOrm.side.value, orderOrm.qty)
+            total_cost, available_qty = book.quote(orderOrm.side.value, orderOrm.qty)
+            if available_qty < orderOrm.qty:
+                reason = 'no liquidity'
+            elif orderOrm.side == SideEnum.BUY and total_cost > userBalanceRUB.available_balance:
+                reason = 'not enough RUB balance'
+            elif orderOrm.side == SideEnum.SELL and orderOrm.qty > userBalanceTicker.available_balance:
+                reason = 'not enough ticker balance'
+
+        if reason:
+            orderOrm.status = StatusEnum.CANCELLED
+            await session.commit()
+            pipe = r.pipeline(transaction=False)
+            cache_orders(pipe, [orderOrm], ticker)
+            await pipe.execute()
+            matcher_logger.info("[%s] market order cancelled", request_id,
+                                extra={'order_id': str(orderOrm.uuid), 'reason': reason})
+            return reason
+
+        total_cost, matched_orders, _ = book.match(orderOrm.side.value, orderOrm.qty)
+        result = {"total_cost": total_cost, "matched_orders": matched_orders, "remaining_qty": 0}
+        await commit_match(r, ticker, orderOrm.side.value, orderOrm.uuid, result)
+
+    orderOrm.status = StatusEnum.EXECUTED
+    orderOrm.filled = orderOrm.qty
+    await execution_orders(
+        orderOrm, ticker, userBalanceRUB, userBalanceTicker, result["matched_orders"], result["total_cost"],
+        session, r
+    )
+
+
+async def match_order_limit(orderOrm: Orders, ticker: str, book: OrderBook, session, r):
+    userBalanceRUB, userBalanceTicker = await get_order_balances(session, orderOrm)
+    result = await get_result(r, match_result_key(orderOrm.uuid))
+    if result is None:
+        await MatchingEngine.ensure_liquidity(r, book, orderOrm.side.value, orderOrm.qty, int(orderOrm.price))
+        total_cost, matched_orders, remaining_qty_order = book.match(
+            orderOrm.side.value, orderOrm.qty, int(orderOrm.price)
+        )
+        resting = None
+        if remaining_qty_order > 0:
+            resting = RestingOrder(str(orderOrm.uuid), int(orderOrm.price), int(remaining_qty_order),
+                                   book.next_seq())
+            book.rest(orderOrm.side.value, resting)
+        result = {"total_cost": total_cost, "matched_orders": matched_orders, "remaining_qty": remaining_qty_order}
+        # сделки и остаток заявки попадают в Redis одним атомарным шагом
+        await commit_match(r, ticker, orderOrm.side.value, orderOrm.uuid, result, resting, orderOrm.user_uuid)
+    total_cost, matched_orders, remaining_qty_order = (
+        result["total_cost"], result["matched_orders"], result["remaining_qty"]
+    )
+
+    if matched_orders:
+        orderOrm.status = StatusEnum.EXECUTED if remaining_qty_order == 0 else StatusEnum.PARTIALLY_EXECUTED
+        orderOrm.filled = orderOrm.qty - remaining_qty_order
+    # сделки и заморозка остатка рассчитываются вместе
+    await execution_orders(
+        orderOrm, ticker, userBalanceRUB, userBalanceTicker, matched_orders, total_cost, session, r,
+        remaining_qty_order
+    )
+
+
+async def cancel_resting_orders(order_uuids: list, ticker: str, request_id, engine: MatchingEngine, r=None):
+    """Снимает заявки одного тикера: со стакана одним Lua-скриптом, в БД одним UPDATE статусов
+    и одним UPDATE балансов, свёрнутых по (пользователь, инструмент)."""
+    try:
+        if not r:
+            r = await redis_client.get_redis()
+        # при повторной доставке часть заявок уже снята со стакана, их остаток берём из сохранённых результатов
+        results = await get_results(r, [cancel_result_key(order_uuid) for order_uuid in order_uuids])
+        pending = [order_uuid for order_uuid, result in zip(order_uuids, results) if result is None]
+        if pending:
+            # стакан загружается до снятия: иначе load_book прочитает уже уменьшенный объём,
+            # и book.cancel вычтет его второй раз
+            book = await engine.get_book(r, ticker)
+            # снимаем по индексу заявок: ни БД, ни догрузки стакана не нужно
+            entries = await cancel_in_book(r, ticker, pending)
+            removed = {}
+            for order_uuid, entry in zip(pending, entries):
+                parsed = parse_index_entry(entry) if entry is not None else None
+                if parsed is None:
+                    # уже исполнена или снята раньше
+                    continue
+                _, book_side, _, resting = parsed
+                book.cancel(book.asks if book_side == 'asks' else book.bids, resting.uuid, resting.qty)
+                removed[order_uuid] = {"side": book_side, "price": resting.price, "qty": resting.qty}
+            results = [result or removed.get(order_uuid) for order_uuid, result in zip(order_uuids, results)]
+
+        cancelled = {UUID(str(order_uuid)): result for order_uuid, result in zip(order_uuids, results) if result}
+        if not cancelled:
+            return
+
+        async with async_session_maker() as session:
+            rub_id = await check_ticker_exists('RUB', session)
+            deltas = defaultdict(lambda: [0, 0])
+            # по instrument_id из заявки: тикер может быть уже удалён
+            rows = await orderManager.cancel_orders(session, list(cancelled))
+            for row in rows:
+                user_uuid, instrument_id = row.user_uuid, row.instrument_id
+                result = cancelled[row.uuid]
+                if row.side == SideEnum.BUY:
+                    summa = result["price"] * result["qty"]
+                    deltas[(user_uuid, rub_id)][0] += summa
+                    deltas[(user_uuid, rub_id)][1] -= summa
+                else:
+                    deltas[(user_uuid, instrument_id)][0] += result["qty"]
+                    deltas[(user_uuid, instrument_id)][1] -= result["qty"]
+            users = {user_uuid for user_uuid, _ in deltas}
+            await balance_cache.begin(r, users)
+            try:
+                await usersManager.apply_balance_deltas(session, deltas)
+                await session.commit()
+            except Exception:
+                await balance_cache.abort(r, users)
+                raise
+            await balance_cache.apply(r, deltas)
+            pipe = r.pipeline(transaction=False)
+            cache_orders(pipe, rows, ticker)
+            await pipe.execute()
+            matcher_logger.info("[%s] %s orders of %s cancelled", request_id, len(cancelled), ticker)
+    except Exception:
+        engine.drop_book(ticker)
+        raise
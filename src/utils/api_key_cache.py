@@ -0,0 +1,103 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from src.schemas.user import UserRedis
+
+REVOKED_CHANNEL = "api_keys_revoked"
+MAX_SIZE = 10000
+# верхняя граница устаревания, если сообщение об отзыве не дошло (например, при переподключении к Redis)
+TTL = 30  # сек
+RETRY_DELAY = 1  # сек
+
+
+class ApiKeyCache:
+    """Проверенные пользователи по API-ключу в памяти процесса: LRU на MAX_SIZE ключей с TTL.
+
+    Отзыв ключа (удаление пользователя) рассылается через REVOKED_CHANNEL и сразу вытесняет запись
+    во всех процессах. Пользователь, прочитанный из Redis/БД до отзыва, в кеш уже не попадёт:
+    put принимает номер поколения, взятый до чтения, а каждый отзыв его увеличивает.
+    Отзывы, разосланные без подписки, потеряны, поэтому при обрыве подписки кеш очищается целиком."""
+
+    def __init__(self):
+        self.users: OrderedDict[str, tuple[float, UserRedis]] = OrderedDict()
+        self.generation = 0
+        self._r = None
+        self._pubsub = None
+        self._task = None
+
+    async def start(self, r):
+        if self._task is not None:
+            return
+        self._r = r
+        await self._subscribe()
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        await self._close_pubsub()
+
+    async def _subscribe(self):
+        self._pubsub = self._r.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(REVOKED_CHANNEL)
+
+    async def _close_pubsub(self):
+        pubsub, self._pubsub = self._pubsub, None
+        if pubsub:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+    async def _listen(self):
+        while True:
+            try:
+                if self._pubsub is None:
+                    await self._subscribe()
+                    # отзывы за время без подписки могли потеряться
+                    self.clear()
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except Exception as e:
+                print(f"api key revocation subscription failed: {e}")
+                await self._close_pubsub()
+                self.clear()
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            if message is not None and message['type'] == 'message':
+                self.evict(message['data'])
+
+    def get(self, api_key: str) -> UserRedis | None:
+        entry = self.users.get(api_key)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self.users[api_key]
+            return None
+        self.users.move_to_end(api_key)
+        return user
+
+    def put(self, api_key: str, user: UserRedis, generation: int):
+        if generation != self.generation:
+            return
+        self.users[api_key] = (time.monotonic() + TTL, user)
+        self.users.move_to_end(api_key)
+        if len(self.users) > MAX_SIZE:
+            self.users.popitem(last=False)
+
+    def evict(self, api_key: str):
+        self.generation += 1
+        self.users.pop(api_key, None)
+
+    def clear(self):
+        # новое поколение: прочитанные до очистки пользователи в кеш уже не попадут
+        self.generation += 1
+        self.users.clear()
+
+    @staticmethod
+    async def revoke(r, api_key: str):
+        await r.publish(REVOKED_CHANNEL, api_key)
+
+
+api_key_cache = ApiKeyCache()
@@ -0,0 +1,146 @@
+# Кеш балансов для GET /balance: HASH balance:{user_uuid} с полями {instrument_id}:available и
+# {instrument_id}:frozen (поле '_' - признак, что кеш заполнен, в том числе для пользователя без балансов).
+#
+# Кеш пишется насквозь: каждый, кто меняет UserBalances, отмечает пользователей до commit (begin),
+# а после commit прибавляет свои приращения к кешу, если он есть (apply), либо только снимает отметку
+# при откате (abort). begin ставит отметку и в сам хеш (поле writing) и сокращает его TTL до WRITING_TTL:
+# пока отметка в хеше, GET /balance считает кеш промахом, поэтому если процесс упал между commit и apply,
+# хеш без приращения не отдаётся, а истекает вместе с отметкой. Заполняется кеш при промахе снимком из БД (fill) и только если с момента чтения
+# balance:{user_uuid}:ver ни одна запись не завершилась и ни одна не идёт (balance:{user_uuid}:writing = 0):
+# иначе снимок мог уже включать приращение, которое apply прибавил бы второй раз, или не включать его.
+
+from collections import defaultdict
+
+CACHE_TTL = 60 * 60  # сек, заодно ограничивает время жизни возможного расхождения с БД
+# отметка записи умершего процесса не должна навсегда запретить заполнение кеша
+WRITING_TTL = 60
+
+# поле хеша: сколько записей балансов пользователя сейчас идёт
+WRITING_FIELD = 'writing'
+
+# KEYS: по 3 ключа на пользователя (кеш, writing, ver); ARGV: ttl отметки
+BEGIN_LUA = """
+for i = 1, #KEYS, 3 do
+    redis.call('INCR', KEYS[i + 1])
+    redis.call('EXPIRE', KEYS[i + 1], ARGV[1])
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('HINCRBY', KEYS[i], 'writing', 1)
+        redis.call('EXPIRE', KEYS[i], ARGV[1])
+    end
+end
+return 1
+"""
+
+# KEYS: по 3 ключа на пользователя (кеш, writing, ver)
+# ARGV: ttl кеша, затем для каждого пользователя число полей и пары поле, приращение (0 полей - откат)
+APPLY_LUA = """
+local pos = 2
+for i = 1, #KEYS, 3 do
+    local n = tonumber(ARGV[pos])
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        for j = 1, n do
+            redis.call('HINCRBYFLOAT', KEYS[i], ARGV[pos + j * 2 - 1], ARGV[pos + j * 2])
+        end
+        if redis.call('HINCRBY', KEYS[i], 'writing', -1) <= 0 then
+            redis.call('HDEL', KEYS[i], 'writing')
+            redis.call('EXPIRE', KEYS[i], ARGV[1])
+        end
+    end
+    pos = pos + n * 2 + 1
+    if redis.call('DECR', KEYS[i + 1]) <= 0 then
+        redis.call('DEL', KEYS[i + 1])
+    end
+    redis.call('INCR', KEYS[i + 2])
+end
+return 1
+"""
+
+# KEYS: кеш, writing, ver; ARGV: версия на момент чтения снимка, ttl кеша, затем пары поле, значение
+FILL_LUA = """
+if (redis.call('GET', KEYS[3]) or '0') ~= ARGV[1] or tonumber(redis.call('GET', KEYS[2]) or 0) > 0 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], '_', 1, unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+def balance_key(user_uuid) -> str:
+    return f"balance:{user_uuid}"
+
+
+def user_keys(user_uuid) -> list[str]:
+    key = balance_key(user_uuid)
+    return [key, f"{key}:writing", f"{key}:ver"]
+
+
+class BalanceCache:
+    def __init__(self):
+        self._begin = None
+        self._apply = None
+        self._fill = None
+
+    def _scripts(self, r):
+        if self._begin is None:
+            self._begin = r.register_script(BEGIN_LUA)
+            self._apply = r.register_script(APPLY_LUA)
+            self._fill = r.register_script(FILL_LUA)
+
+    async def begin(self, r, user_uuids):
+        """До commit транзакции, меняющей балансы пользователей."""
+        self._scripts(r)
+        keys = []
+        for user_uuid in set(user_uuids):
+            keys += user_keys(user_uuid)
+        await self._begin(keys=keys, args=[WRITING_TTL])
+
+    async def apply(self, r, deltas: dict):
+        """После commit: приращения {(user_uuid, instrument_id): [available, frozen]}."""
+        self._scripts(r)
+        fields = defaultdict(list)
+        for (user_uuid, instrument_id), (available, frozen) in deltas.items():
+            fields[user_uuid] += [f"{instrument_id}:available", available, f"{instrument_id}:frozen", frozen]
+        await self._write(fields)
+
+    async def abort(self, r, user_uuids):
+        """Транзакция откатилась: только снимаем отметку."""
+        self._scripts(r)
+        await self._write({user_uuid: [] for user_uuid in set(user_uuids)})
+
+    async def _write(self, fields: dict):
+        keys, args = [], [CACHE_TTL]
+        for user_uuid, user_fields in fields.items():
+            keys += user_keys(user_uuid)
+            args += [len(user_fields) // 2, *user_fields]
+        await self._apply(keys=keys, args=args)
+
+    @staticmethod
+    async def version(r, user_uuid) -> str:
+        return await r.get(f"{balance_key(user_uuid)}:ver") or '0'
+
+    async def fill(self, r, user_uuid, version: str, balances: dict):
+        """Снимок из БД {instrument_id: (available, frozen)}, прочитанный после version()."""
+        self._scripts(r)
+        args = [version, CACHE_TTL]
+        for instrument_id, (available, frozen) in balances.items():
+            args += [f"{instrument_id}:available", available, f"{instrument_id}:frozen", frozen]
+        await self._fill(keys=user_keys(user_uuid), args=args)
+
+
+def is_readable(cached: dict) -> bool:
+    """Хеш есть и ни одна запись балансов в него сейчас не идёт."""
+    return bool(cached) and WRITING_FIELD not in cached
+
+
+def parse_balances(cached: dict) -> dict[int, float]:
+    """Кеш -> {instrument_id: available + frozen}."""
+    balances = defaultdict(float)
+    for field, value in cached.items():
+        if field != '_':
+            balances[int(field.split(':')[0])] += float(value)
+    return balances
+
+
+balance_cache = BalanceCache()
@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+from fastapi import HTTPException, status
+from sqlalchemy import select
+
+from src.db.db import async_session_maker
+from src.models import Instruments
+
+INSTRUMENTS_CHANNEL = "instruments_changed"
+# полное перечитывание без сообщений: верхняя граница устаревания, если сообщение потерялось
+RELOAD_INTERVAL = 60  # сек
+RETRY_DELAY = 1  # сек
+
+
+class InstrumentRegistry:
+    """Инструменты в памяти процесса: тикер -> id активного инструмента и id -> тикер любого,
+    в том числе удалённого. Загружается при старте и перечитывается из БД целиком по сообщению
+    в INSTRUMENTS_CHANNEL, которое шлют добавление и удаление инструмента.
+
+    Подписка оформляется до первой загрузки, поэтому изменение, случившееся во время загрузки,
+    не теряется, а только вызывает ещё одно перечитывание. Кроме того, реестр перечитывается
+    раз в RELOAD_INTERVAL, а при обрыве подписки переподписывается и перечитывается сразу."""
+
+    def __init__(self):
+        self.ids: dict[str, int] = {}
+        self.tickers: dict[int, str] = {}
+        self.active: set[int] = set()
+        self.loaded = False
+        self._r = None
+        self._pubsub = None
+        self._task = None
+
+    async def start(self, r):
+        if self._task is not None:
+            return
+        self._r = r
+        await self._subscribe()
+        self._task = asyncio.create_task(self._listen())
+        await self.reload()
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        await self._close_pubsub()
+
+    async def _subscribe(self):
+        self._pubsub = self._r.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(INSTRUMENTS_CHANNEL)
+
+    async def _close_pubsub(self):
+        pubsub, self._pubsub = self._pubsub, None
+        if pubsub:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+    async def _listen(self):
+        next_reload = time.monotonic() + RELOAD_INTERVAL
+        while True:
+            try:
+                if self._pubsub is None:
+                    await self._subscribe()
+                    # сообщения, пришедшие без подписки, потеряны
+                    next_reload = 0
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True,
+                                                         timeout=max(next_reload - time.monotonic(), 0))
+            except Exception as e:
+                print(f"instrument registry subscription failed: {e}")
+                await self._close_pubsub()
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            if message is None and time.monotonic() < next_reload:
+                continue
+            try:
+                await self.reload()
+                next_reload = time.monotonic() + RELOAD_INTERVAL
+            except Exception as e:
+                print(f"instrument registry reload failed: {e}")
+                next_reload = time.monotonic() + RETRY_DELAY
+
+    async def reload(self):
+        async with async_session_maker() as session:
+            rows = (await session.execute(
+                select(Instruments.id, Instruments.ticker, Instruments.is_active)
+            )).all()
+        # словари подменяются целиком, читатели никогда не видят наполовину обновлённые
+        self.ids = {row.ticker: row.id for row in rows if row.is_active}
+        self.tickers = {row.id: row.ticker for row in rows}
+        self.active = {row.id for row in rows if row.is_active}
+        self.loaded = True
+
+    async def invalidate(self, r):
+        """После commit изменения инструментов: свой процесс перечитывает сразу, остальные - по сообщению."""
+        await self.reload()
+        await r.publish(INSTRUMENTS_CHANNEL, '1')
+
+    def get_id(self, ticker: str) -> int:
+        instrument_id = self.ids.get(ticker)
+        if instrument_id is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="ticker not found")
+        return instrument_id
+
+
+instrument_registry = InstrumentRegistry()
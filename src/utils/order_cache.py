@@ -0,0 +1,23 @@
+# Статусы заявок для GET /order/{id} и GET /order/status: order_status:{uuid} - готовый JSON ответа.
+# Расчёт и отмена перезаписывают запись после commit, чтение из БД при промахе только дополняет кеш (NX):
+# снимок, прочитанный до чужого commit, не затрёт более свежую запись.
+
+from src.schemas.order import order_json
+
+ORDER_CACHE_TTL = 60 * 60  # сек
+
+
+def order_status_key(order_id) -> str:
+    return f"order_status:{order_id}"
+
+
+def cache_orders(pipe, rows, ticker: str | None = None):
+    """После commit расчёта или отмены: строки с полями ORDER_STATUS_COLUMNS (или ORM-заявки)."""
+    for row in rows:
+        pipe.set(order_status_key(row.uuid), order_json(row, ticker), ex=ORDER_CACHE_TTL)
+
+
+def fill_order_cache(pipe, rows):
+    """Промах кеша: строки orderManager.select_order_rows."""
+    for row in rows:
+        pipe.set(order_status_key(row.uuid), order_json(row), ex=ORDER_CACHE_TTL, nx=True)
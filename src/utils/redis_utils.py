@@ -3,10 +3,13 @@ import json
 from fastapi import HTTPException, status
 
 from src.db.instrumentManager import instrumentsManager
+from src.engine.candles import INTERVALS, candles_key
+from src.engine.scripts import TICKERS_KEY, TICKER_FIELDS, trade_minutes_key
 from src.logger import cache_logger
-from src.models.orders import SideEnum
 from src.redis_conn import redis_client
+from src.utils.api_key_cache import api_key_cache
 from src.utils.custom_serializer import custom_serializer_json
+from src.utils.instrument_registry import instrument_registry
 
 
 async def update_instruments_cache(instruments):
@@ -39,13 +42,19 @@ async def update_cache_after_delete(ticker: str, request_id):
         await redis.delete(f"ticker:{ticker}")
         await redis.delete(f"orderbook:{ticker}:asks")
         await redis.delete(f"orderbook:{ticker}:bids")
+        await redis.delete(f"orderbook:{ticker}:volume")
+        await redis.delete(f"depth:{ticker}:asks", f"depth:{ticker}:asks:prices",
+                           f"depth:{ticker}:bids", f"depth:{ticker}:bids:prices")
+        await redis.delete(*[candles_key(ticker, interval) for interval in INTERVALS])
+        await redis.delete(trade_minutes_key(ticker))
+        await redis.hdel(TICKERS_KEY, *[f"{ticker}:{field}" for field in TICKER_FIELDS])
         await redis.hdel("instruments", ticker)
 
         await redis.expire("instruments", 420)
-        cache_logger.info(f"[{request_id}] delete instrument", extra={'ticker': ticker})
+        cache_logger.info("[%s] delete instrument", request_id, extra={'ticker': ticker})
 
     except Exception as e:
-        cache_logger.error(f"[{request_id}] delete instrument error", exc_info=e, extra={'ticker': ticker})
+        cache_logger.error("[%s] delete instrument error", request_id, exc_info=e, extra={'ticker': ticker})
 
 
 async def load_user_redis(api_key, user, request_id):
@@ -60,10 +69,10 @@ async def load_user_redis(api_key, user, request_id):
         redis = await redis_client.get_redis()
         await redis.set(f'user_key:{api_key}', json.dumps(data_user_redis, default=custom_serializer_json), ex=3600)
 
-        cache_logger.info(f"[{request_id}] load user redis", extra={'user_id': str(user.uuid)})
+        cache_logger.info("[%s] load user redis", request_id, extra={'user_id': str(user.uuid)})
         return data_user_redis
     except Exception as e:
-        cache_logger.error(f"[{request_id}] load user redis error", extra={'user_id': str(user.uuid)})
+        cache_logger.error("[%s] load user redis error", request_id, extra={'user_id': str(user.uuid)})
         raise
 
 
@@ -72,11 +81,11 @@ async def clear_instruments_cache(request_id):
         redis = await redis_client.get_redis()
         await redis.delete("instruments")
         cache_logger.info(
-            f"[{request_id}] Delete instruments"
+            "[%s] Delete instruments", request_id
         )
     except Exception as e:
         cache_logger.error(
-            f"[{request_id}] ERROR Delete instruments", exc_info=e
+            "[%s] ERROR Delete instruments", request_id, exc_info=e
         )
 
 
@@ -84,17 +93,23 @@ async def clear_user_cache(api_key, request_id):
     try:
         redis = await redis_client.get_redis()
         await redis.delete(f'user_key:{api_key}')
+        # и из памяти всех процессов API
+        await api_key_cache.revoke(redis, api_key)
         cache_logger.info(
-            f"[{request_id}] Delete user cache",
+            "[%s] Delete user cache", request_id,
             extra={'api_key': api_key[:-10]}
         )
     except Exception as e:
         cache_logger.error(
-            f"[{request_id}]ERROR Delete user", exc_info=e
+            "[%s]ERROR Delete user", request_id, exc_info=e
         )
 
 
 async def check_ticker_exists(ticker, session) -> int:
+    # в API и воркерах матчинга инструменты уже в памяти процесса
+    if instrument_registry.loaded:
+        return instrument_registry.get_id(ticker)
+
     redis = await redis_client.get_redis()
 
     # Проверка, есть ли кеш
@@ -125,121 +140,3 @@ async def check_ticker_exists(ticker, session) -> int:
         return instrument["id"]
     except (json.JSONDecodeError, KeyError):
         raise HTTPException(status_code=500, detail="Instrument data corrupted")
-
-
-async def calculate_order_cost(
-        r,
-        ticker: str,
-        quantity: float,
-        side: str,  # 'BUY' или 'SELL'
-):
-    orderbook_key = f"orderbook:{ticker}:{'asks' if side == 'BUY' else 'bids'}"
-
-
-    if side == 'BUY':
-        orders = await r.zrange(orderbook_key, 0, -1, withscores=True)
-        orders = sorted(orders, key=lambda x: (int(x[1]), round(float(x[0].split(':')[3]), 3)))
-        print(orders)
-    else:
-        orders = await r.zrevrange(orderbook_key, 0, -1, withscores=True)
-        orders = sorted(orders, key=lambda x: (-int(x[1]), round(float(x[0].split(':')[3]), 3)))
-        print(orders)
-
-    remaining_qty = quantity
-    total_cost = 0.0
-    matched_orders = []
-
-    for order_data, price in orders:
-
-        _, order_qty, uuid_orders, timestamp = order_data.split(":")
-        order_qty = float(order_qty)
-
-        qty_to_take = min(remaining_qty, order_qty)
-        cost = qty_to_take * price
-
-        matched_orders.append({
-            "price": price,
-            "quantity": qty_to_take,
-            "cost": cost,
-            "uuid": uuid_orders,
-            "original_qty": order_qty,
-            "timestamp":timestamp
-        })
-
-        total_cost += cost
-        remaining_qty -= qty_to_take
-
-        if remaining_qty <= 0:
-            break
-
-    if remaining_qty > 0:
-        raise ValueError(f"Недостаточно ликвидности. Осталось неисполненных: {remaining_qty}")
-    return total_cost, matched_orders
-
-
-async def match_limit_order(
-        r,
-        ticker: str,
-        quantity: float,
-        price_limit: float,
-        side: str  # 'BUY' or 'SELL'
-):
-    orderbook_key = f"orderbook:{ticker}:{'asks' if side == 'BUY' else 'bids'}"
-
-    if side == 'BUY':
-        # asks сортируются от низкой к высокой, берём те, что <= limit
-        orders = await r.zrangebyscore(orderbook_key, '-inf', price_limit, withscores=True)
-        orders = sorted(orders, key=lambda x: (int(x[1]), round(float(x[0].split(':')[3]), 3)))
-        print(orders)
-    else:
-        # bids от высокой к низкой, берём те, что >= limit
-        orders = await r.zrevrangebyscore(orderbook_key, '+inf', price_limit, withscores=True)
-        print(orders)
-        orders = sorted(orders, key=lambda x: (-int(x[1]), round(float(x[0].split(':')[3]), 3)))
-        print(orders)
-
-    remaining_qty = quantity
-    total_cost = 0.0
-    matched_orders = []
-
-    for order_data, price in orders:
-        _, order_qty, order_uuid, timestamp = order_data.split(":")
-        order_qty = float(order_qty)
-
-        qty_to_take = min(remaining_qty, order_qty)
-        cost = qty_to_take * price
-
-        matched_orders.append({
-            "price": price,
-            "quantity": qty_to_take,
-            "cost": cost,
-            "uuid": order_uuid,
-            "original_qty": order_qty,
-            "timestamp": timestamp
-        })
-
-        total_cost += cost
-        remaining_qty -= qty_to_take
-
-        if remaining_qty <= 0:
-            break
-
-    return total_cost, matched_orders, remaining_qty
-
-def update_match_orders(pipe, matched_orders, ticker, direction):
-    orderbook_key = f"orderbook:{ticker}:{'bids' if direction == SideEnum.SELL else 'asks'}"
-    for item in matched_orders:
-        order_uuid = item.get("uuid")
-        price_old = item.get("price")
-        quantity = item.get("quantity")
-        original_qty = item.get("original_qty")
-        timestamp = item.get("timestamp")
-        old_entry = f"{int(price_old)}:{int(original_qty)}:{order_uuid}:{timestamp}"
-        pipe.zrem(orderbook_key, old_entry)
-
-        remaining_qty = original_qty - quantity
-        if remaining_qty > 0:
-            new_entry = f"{int(price_old)}:{int(remaining_qty)}:{order_uuid}:{timestamp}"
-            pipe.zadd(orderbook_key, {new_entry: price_old})
-        else:
-            pipe.hdel('active_orders', order_uuid)